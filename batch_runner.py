@@ -0,0 +1,301 @@
+import argparse
+import functools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from equity_calculator import EquityCalculator
+
+
+PILLARS = ["Responsibility", "Capacity", "Needs", "Engagement"]
+
+# Defaults of the Streamlit app for columns a scenario file leaves out
+DEFAULTS = {"total_value": 300, "include_UMIC": True, "exclude_US": True}
+
+# Calculator shared by the scenario chunks of one worker
+_BATCH_CALCULATOR = None
+
+
+def _flatten_yaml_scenario(entry):
+
+    row = {key: value for key, value in entry.items() if key not in ("weights", "variables")}
+
+    variables = entry.get("variables", {})
+    if isinstance(variables, (list, tuple)):
+        variables = dict(zip(PILLARS, variables))
+    row.update(variables)
+    row.update({pillar + "_weight": weight for pillar, weight in entry.get("weights", {}).items()})
+
+    return row
+
+
+def read_scenarios(path, chunk_size=1000):
+    """
+    Read a scenario file in chunks
+    Inputs:
+        path: CSV or YAML file. CSV columns (and flat YAML keys) are scenario (optional name), Responsibility,
+            Capacity, Needs and Engagement (the selected variable names), Responsibility_weight .. Engagement_weight,
+            and optionally total_value, include_UMIC and exclude_US. YAML is a list of such mappings, or a mapping
+            with "scenarios" and "defaults"; "weights" and "variables" may be given as nested mappings per pillar
+            (variables also as a list in pillar order).
+        chunk_size: Scenarios per chunk
+    Yields:
+        scenarios: pandas dataframe of up to chunk_size scenarios, with unnamed scenarios called S<row number>
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".yaml", ".yml"):
+        import yaml
+
+        with open(path) as f:
+            document = yaml.safe_load(f) or []
+        defaults = {}
+        if isinstance(document, dict):
+            defaults, document = document.get("defaults", {}), document.get("scenarios", [])
+        chunks = (pd.DataFrame([{**defaults, **_flatten_yaml_scenario(entry)}
+                                for entry in document[start:start + chunk_size]])
+                  for start in range(0, len(document), chunk_size))
+    elif extension == ".csv":
+        chunks = pd.read_csv(path, chunksize=chunk_size)
+    else:
+        raise ValueError(f"Unsupported scenario file '{path}'; expected .csv, .yaml or .yml")
+
+    start = 0
+    for chunk in chunks:
+        chunk = chunk.reset_index(drop=True)
+        names = [f"S{i}" for i in range(start + 1, start + len(chunk) + 1)]
+        chunk["scenario"] = chunk["scenario"].fillna(pd.Series(names)) if "scenario" in chunk else names
+        start += len(chunk)
+        yield chunk
+
+
+def _to_bool(values):
+
+    if values.dtype == bool:
+        return values.to_numpy()
+
+    return values.astype(str).str.strip().str.lower().isin(["true", "1", "1.0", "yes", "y"]).to_numpy()
+
+
+def prepare_scenarios(scenarios, variable_dict):
+    """
+    Check a chunk of scenarios and convert it to the arrays the workers evaluate
+    Returns:
+        inputs: dictionary of names, variables (list of N lists of variable names), weights (N x 4),
+            total_value (N), include_UMIC (N) and exclude_US (N)
+    """
+
+    missing = [column for column in PILLARS + [p + "_weight" for p in PILLARS] if column not in scenarios]
+    if missing:
+        raise ValueError(f"Scenario file is missing the columns {missing}")
+
+    for column, default in DEFAULTS.items():
+        scenarios[column] = scenarios[column].fillna(default) if column in scenarios else default
+
+    unknown = ~scenarios[PILLARS].isin(list(variable_dict)).all(axis=1)
+    if unknown.any():
+        raise ValueError(f"Unknown variables in scenarios {scenarios.loc[unknown, 'scenario'].tolist()[:10]}; "
+                         f"expected names among {list(variable_dict)}")
+
+    weights = scenarios[[p + "_weight" for p in PILLARS]].to_numpy(dtype=float)
+    invalid = np.isnan(weights).any(axis=1) | (weights < 0).any(axis=1) | (weights[:, :2].sum(axis=1) <= 0)
+    if invalid.any():
+        raise ValueError(f"Invalid weights in scenarios {scenarios.loc[invalid, 'scenario'].tolist()[:10]}; weights "
+                         "must be non-negative, with a positive Responsibility and Capacity total")
+
+    return {
+        "names": scenarios["scenario"].astype(str).to_numpy(),
+        "variables": scenarios[PILLARS].to_numpy().tolist(),
+        "weights": weights,
+        "total_value": scenarios["total_value"].to_numpy(dtype=float),
+        "include_UMIC": _to_bool(scenarios["include_UMIC"]),
+        "exclude_US": _to_bool(scenarios["exclude_US"]),
+    }
+
+
+def evaluate_scenarios(equity_calculator, inputs):
+    """
+    Allocations and contributions of a chunk of scenarios, with the batched calculator methods
+    Returns:
+        results: long-format pandas dataframe with scenario, measure ("allocation" or "contribution"),
+            the key column (ISO, or the unit column for sub-national data) and value_USDbn
+    """
+
+    data = equity_calculator.data
+    key_column = equity_calculator.unit_column or "ISO"
+    names = inputs["names"]
+
+    recipients = data.loc[data["AnnexII_countries"] == 0, key_column].to_numpy()
+    allocations = equity_calculator.calculate_weighted_equity_batch(inputs["weights"], inputs["variables"],
+                                                                    inputs["total_value"])
+    frames = [pd.DataFrame({"scenario": np.repeat(names, len(recipients)), "measure": "allocation",
+                            key_column: np.tile(recipients, len(names)), "value_USDbn": allocations.ravel()})]
+
+    # Contributions, one batch per donor pool
+    pools = np.stack([inputs["include_UMIC"], inputs["exclude_US"]], axis=1)
+    for include_UMIC, exclude_US in np.unique(pools, axis=0):
+        rows = np.flatnonzero((pools == [include_UMIC, exclude_US]).all(axis=1))
+        donors = data.loc[equity_calculator.get_donor_pool(bool(include_UMIC), bool(exclude_US)), key_column].to_numpy()
+        contributions = equity_calculator.calculate_contributions_batch(
+            inputs["weights"][rows], [inputs["variables"][i] for i in rows], inputs["total_value"][rows],
+            include_UMIC=bool(include_UMIC), exclude_US=bool(exclude_US))
+        frames.append(pd.DataFrame({"scenario": np.repeat(names[rows], len(donors)), "measure": "contribution",
+                                    key_column: np.tile(donors, len(rows)), "value_USDbn": contributions.ravel()}))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def _init_batch_worker(data, unit_column, dtype):
+
+    global _BATCH_CALCULATOR
+    _BATCH_CALCULATOR = EquityCalculator(data, unit_column=unit_column, dtype=dtype)
+
+
+def _evaluate_chunk(inputs):
+
+    return evaluate_scenarios(_BATCH_CALCULATOR, inputs)
+
+
+class ResultWriter:
+    """
+    Append result chunks to one Parquet file (a row group per chunk) or CSV file, chosen by the extension
+    """
+
+    def __init__(self, path, compression="zstd"):
+
+        self.path = path
+        self.compression = compression
+        self.format = "csv" if path.lower().endswith(".csv") else "parquet"
+        self.rows = 0
+        self._writer = None
+        self._temp_path = path + f".{os.getpid()}.tmp"
+
+    def write(self, results):
+
+        if self.format == "csv":
+            results.to_csv(self._temp_path, mode="w" if self.rows == 0 else "a", header=self.rows == 0, index=False)
+        else:
+            table = pa.Table.from_pandas(results, preserve_index=False)
+            table = table.set_column(1, "measure", table.column("measure").dictionary_encode())
+            table = table.set_column(2, table.field(2).name, table.column(2).dictionary_encode())
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self._temp_path, table.schema, compression=self.compression)
+            self._writer.write_table(table)
+        self.rows += len(results)
+
+    def close(self):
+
+        if self._writer is not None:
+            self._writer.close()
+
+        # Only a complete run replaces the output file
+        if os.path.exists(self._temp_path):
+            os.replace(self._temp_path, self.path)
+
+    def abort(self):
+
+        if self._writer is not None:
+            self._writer.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+def run_batch(data, scenarios_path, output_path, chunk_size=1000, max_workers=None, backend="processes",
+              fast_load=True, unit_column=None, dtype=np.float64, progress=None):
+    """
+    Evaluate every scenario of a scenario file and stream the results to Parquet or CSV as chunks finish
+    Inputs:
+        data: Path to the NCQG workbook, or a "Summary"-shaped pandas dataframe, loaded once and shared by every worker
+        scenarios_path: CSV or YAML scenario file (see read_scenarios)
+        output_path: .parquet or .csv file of long-format results (see evaluate_scenarios), in scenario file order
+        chunk_size: Scenarios per task
+        max_workers: Number of workers (defaults to the number of CPUs); 0 evaluates in this process
+        backend: "processes" or "threads"
+        fast_load, unit_column, dtype: Passed to EquityCalculator
+        progress: Optional callback(done scenarios, result rows) called as each chunk is written
+    Returns:
+        summary: dictionary of scenarios, rows and seconds
+    """
+
+    start = time.perf_counter()
+    equity_calculator = EquityCalculator(data, fast_load=fast_load, unit_column=unit_column, dtype=dtype)
+    chunks = (prepare_scenarios(chunk, equity_calculator.variable_dict)
+              for chunk in read_scenarios(scenarios_path, chunk_size))
+
+    writer = ResultWriter(output_path)
+    done = 0
+
+    def write(inputs, results):
+        nonlocal done
+        writer.write(results)
+        done += len(inputs["names"])
+        if progress is not None:
+            progress(done, writer.rows)
+
+    try:
+        if max_workers == 0:
+            for inputs in chunks:
+                write(inputs, evaluate_scenarios(equity_calculator, inputs))
+
+        else:
+            if backend == "processes":
+                executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_batch_worker,
+                                               initargs=(equity_calculator.data, unit_column, dtype))
+                evaluate = _evaluate_chunk
+            elif backend == "threads":
+                executor = ThreadPoolExecutor(max_workers=max_workers)
+                evaluate = functools.partial(evaluate_scenarios, equity_calculator)
+            else:
+                raise ValueError(f"Unknown backend '{backend}'; expected 'processes' or 'threads'")
+
+            # Keep a bounded window of chunks in flight and write them in file order as they finish,
+            # so neither the scenarios nor the results are ever held in memory all at once
+            window = 2 * (max_workers or os.cpu_count() or 1)
+            pending = []
+            with executor:
+                for inputs in chunks:
+                    pending.append((inputs, executor.submit(evaluate, inputs)))
+                    while len(pending) >= window or (pending and pending[0][1].done()):
+                        inputs, future = pending.pop(0)
+                        write(inputs, future.result())
+                for inputs, future in pending:
+                    write(inputs, future.result())
+
+    except BaseException:
+        writer.abort()
+        raise
+
+    writer.close()
+
+    return {"scenarios": done, "rows": writer.rows, "seconds": time.perf_counter() - start}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Evaluate every scenario of a CSV or YAML scenario file without the "
+                                                 "Streamlit app and stream the allocations and contributions to a "
+                                                 "Parquet or CSV file")
+    parser.add_argument("scenarios", help="CSV or YAML scenario file")
+    parser.add_argument("output", help="Output .parquet or .csv file")
+    parser.add_argument("--data", default="NCQG Data.xlsx", help="NCQG workbook")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Scenarios per task")
+    parser.add_argument("--workers", type=int, default=None, help="Number of workers; 0 runs in this process")
+    parser.add_argument("--backend", choices=["processes", "threads"], default="processes")
+    parser.add_argument("--no-fast-load", action="store_true", help="Read the workbook instead of its columnar cache")
+    parser.add_argument("--float32", action="store_true", help="Evaluate in single precision")
+    args = parser.parse_args()
+
+    def report(done, rows):
+        print(f"\r{done} scenarios, {rows} rows", end="", file=sys.stderr, flush=True)
+
+    summary = run_batch(args.data, args.scenarios, args.output, chunk_size=args.chunk_size, max_workers=args.workers,
+                        backend=args.backend, fast_load=not args.no_fast_load,
+                        dtype=np.float32 if args.float32 else np.float64, progress=report)
+    print(f"\n{summary['scenarios']} scenarios ({summary['rows']} rows) written to {args.output} "
+          f"in {summary['seconds']:.1f} s", file=sys.stderr)
@@ -0,0 +1,317 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from equity_calculator import EquityCalculator, count_weight_combos
+
+
+BASELINE_PATH = "benchmark_baseline.json"
+
+WEIGHTS = {"Responsibility": 2, "Capacity": 3, "Needs": 1, "Engagement": 4}
+VARIABLES = ["Cumulative Emissions since 1950", "Gross National Income per capita",
+             "Physical Climate Risk (EIB)", "UN Multilateral Engagement Score"]
+
+# Units scale at the first resolution, weight grids scale at the first unit count
+# (resolution 10 -> 84 weight combos, 20 -> 969, 40 -> 9,139, 86 -> 98,770)
+PRESETS = {
+    "quick": {"units": [200, 2000], "resolutions": [10, 20]},
+    "full": {"units": [200, 2000, 20000, 100000], "resolutions": [10, 20, 40, 86]},
+}
+
+
+def make_synthetic_summary(n_units, n_regions=20, seed=0):
+    """
+    Synthetic "Summary"-shaped dataframe with the identity, membership and indicator columns
+    Inputs:
+        n_units: Number of rows (countries or sub-national units)
+        n_regions: Number of distinct regions
+        seed: Random seed
+    Returns:
+        data: pandas dataframe with heavy-tailed indicators, a few missing emissions values,
+            ~13% Annex II and ~60% upper-middle/high income rows, and one "USA" Annex II row
+    """
+
+    rng = np.random.default_rng(seed)
+    iso = np.array([f"U{i:06d}" for i in range(n_units)])
+    iso[0] = "USA"
+
+    annex = rng.random(n_units) < 0.135
+    annex[0] = True
+    above_middle = annex | (rng.random(n_units) < 0.54)
+
+    data = pd.DataFrame({
+        "Country": np.char.add("Unit ", iso),
+        "ISO": iso,
+        "Region": np.char.add("Region ", rng.integers(0, n_regions, n_units).astype(str)),
+        "above_middle_countries": above_middle.astype(np.int8),
+        "AnnexII_countries": annex.astype(np.int8),
+    })
+
+    # Emissions and income span several orders of magnitude, risk and engagement scores do not
+    for column, mean, sigma in [("X1850_2024", 21.0, 2.5), ("X1990_2024", 20.5, 2.5), ("GHG_historical_pc", 5.5, 1.2),
+                                ("GNI_avg", 25.0, 2.0), ("GNI_debt_avg", 25.0, 2.0), ("GNI_PPP_pc_avg", 9.5, 1.0)]:
+        data[column] = rng.lognormal(mean, sigma, n_units)
+    data["GAIN_CR"] = rng.uniform(25, 75, n_units)
+    data["EIB_PR"] = rng.gamma(1.5, 0.6, n_units) + 0.01
+    data["UN Index"] = rng.uniform(30, 95, n_units)
+
+    missing = rng.random(n_units) < 0.01
+    missing[0] = False
+    data.loc[missing, ["X1850_2024", "X1990_2024"]] = np.nan
+
+    return data
+
+
+def make_postprocessor_data(equity_calculator):
+    """
+    postprocessor.Data with every donor pool's contributions ("HIC") and the allocations ("Robust_Share")
+    taken from one weighting of the calculator's data, in place of the robust results
+    """
+
+    from postprocessor import Data
+
+    contributions = equity_calculator.calculate_contributions(WEIGHTS, VARIABLES, 300, include_UMIC=False,
+                                                              exclude_US=False)
+    allocations = equity_calculator.calculate_weighted_equity(WEIGHTS, VARIABLES, 300)
+
+    contributions = contributions.assign(Robust_Contribution=contributions["Weighted_Contributions_Score"])
+    allocations = allocations.assign(Robust_Share=allocations["Weighted_Equity_Score"])
+    results = {family: contributions for family in ["contributions", "contributions_US", "contributions_UMIC",
+                                                    "contributions_UMIC_US"]}
+    results["allocations"] = allocations
+
+    data = Data(results=results, regions=equity_calculator.data[["ISO", "Region"]])
+
+    return data
+
+
+def _weighted_equity(equity_calculator, resolution):
+    return lambda: equity_calculator.calculate_weighted_equity(WEIGHTS, VARIABLES, 300)["Allocation_USDbn"]
+
+
+def _contributions(equity_calculator, resolution):
+    return lambda: equity_calculator.calculate_contributions(WEIGHTS, VARIABLES, 300, include_UMIC=True,
+                                                             exclude_US=True)["Contributions_USDbn"]
+
+
+def _aggregate_to_regions(equity_calculator, resolution):
+    allocations = equity_calculator.calculate_weighted_equity(WEIGHTS, VARIABLES, 300)
+    return lambda: equity_calculator.aggregate_to_regions(allocations)["Allocation_USDbn"]
+
+
+def _robust_allocation(equity_calculator, resolution):
+    return lambda: equity_calculator.calculate_robust_allocation(resolution, streaming=True)[0]["Robust_Share"]
+
+
+def _robust_allocation_grid(equity_calculator, resolution):
+    return lambda: equity_calculator.calculate_robust_allocation(resolution)[0]["Robust_Share"]
+
+
+def _robust_contributions(equity_calculator, resolution):
+    def run():
+        frames, stats = equity_calculator.calculate_robust_contributions_pools(resolution=resolution, streaming=True)
+        return np.concatenate([frame["Robust_Contribution"].to_numpy() for frame in frames])
+    return run
+
+
+def _sankey_flows(equity_calculator, resolution):
+    data = make_postprocessor_data(equity_calculator)
+    return lambda: np.sort(data.make_sankey_flows_net(contrib_col="HIC", dist_col="Robust_Share")["value"].to_numpy())
+
+
+def _sankey_grouped(equity_calculator, resolution):
+    data = make_postprocessor_data(equity_calculator)
+    flows = data.make_sankey_flows_net(contrib_col="HIC", dist_col="Robust_Share")
+    return lambda: np.sort(data.build_sankey_grouped_by_region(flows, threshold_billion=5)["value"].to_numpy())
+
+
+# name -> (setup returning a zero-argument run, uses the weight grid, largest number of units)
+BENCHMARKS = {
+    "calculate_weighted_equity": (_weighted_equity, False, None),
+    "calculate_contributions": (_contributions, False, None),
+    "aggregate_to_regions": (_aggregate_to_regions, False, None),
+    "calculate_robust_allocation": (_robust_allocation, True, None),
+    "calculate_robust_allocation_grid": (_robust_allocation_grid, True, 20000),
+    "calculate_robust_contributions": (_robust_contributions, True, None),
+    "make_sankey_flows_net": (_sankey_flows, False, 5000),
+    "build_sankey_grouped_by_region": (_sankey_grouped, False, 2000),
+}
+
+
+def fingerprint(values):
+    """
+    Order-sensitive summary of an output: [size, sum, projection onto a fixed random vector]
+    """
+
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64).ravel())
+    probe = np.random.default_rng(0).random(values.size)
+
+    return [int(values.size), float(values.sum()), float(values @ probe)]
+
+
+def measure(run, repeats=3):
+    """
+    Best wall-clock time over repeats, then peak traced memory and the output of one more run
+    """
+
+    seconds = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        output = run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"seconds": seconds, "peak_memory_mb": peak / 1e6, "fingerprint": fingerprint(output)}
+
+
+def get_cases(units, resolutions):
+    """
+    (units, resolution) pairs: every unit count at the first resolution and every resolution at the first unit count
+    """
+
+    return [(n, resolutions[0]) for n in units] + [(units[0], r) for r in resolutions[1:]]
+
+
+def run_benchmarks(units, resolutions, names=None, repeats=3, log=print):
+    """
+    Run every selected benchmark over the scaling cases
+    Returns:
+        results: dictionary of "name[units=..,combos=..]" -> seconds, peak_memory_mb and output fingerprint
+    """
+
+    names = names or list(BENCHMARKS)
+    results = {}
+
+    # The robust methods write their CSVs to output_dir, the working directory by default
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="ncqg_benchmark_") as directory:
+        os.chdir(directory)
+        try:
+            calculators = {}
+            for n_units, resolution in get_cases(units, resolutions):
+                if n_units not in calculators:
+                    calculators[n_units] = EquityCalculator(make_synthetic_summary(n_units))
+
+                for name in names:
+                    setup, uses_grid, max_units = BENCHMARKS[name]
+                    if max_units is not None and n_units > max_units:
+                        continue
+                    if not uses_grid and resolution != resolutions[0]:
+                        continue
+
+                    combos = count_weight_combos(resolution) if uses_grid else None
+                    key = f"{name}[units={n_units}" + (f",combos={combos}]" if uses_grid else "]")
+                    try:
+                        run = setup(calculators[n_units], resolution)
+                    except ImportError as error:
+                        log(f"{key}: skipped ({error})")
+                        continue
+
+                    results[key] = measure(run, repeats)
+                    log(f"{key}: {results[key]['seconds'] * 1000:.1f} ms, {results[key]['peak_memory_mb']:.1f} MB")
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def compare(results, baseline, time_tolerance=0.25, memory_tolerance=0.25, rtol=1e-6, reference=None):
+    """
+    Regressions of results against a baseline
+    Inputs:
+        time_tolerance, memory_tolerance: Allowed relative increase in time and peak memory
+        rtol: Relative tolerance of the output fingerprints
+        reference: Optional dictionary of key -> fingerprint of the original (pre-optimisation) methods; outputs are
+            checked against it where present and against the baseline's own fingerprints otherwise
+    Returns:
+        problems: list of messages, empty if nothing regressed and every output matches
+    """
+
+    reference = reference or {}
+    problems = []
+    for key, result in results.items():
+        stored = baseline.get(key)
+        if stored is not None:
+            # Absolute slack of 5 ms and 1 MB keeps timer and allocator noise on the smallest cases out
+            if result["seconds"] > stored["seconds"] * (1 + time_tolerance) + 0.005:
+                problems.append(f"{key}: time {result['seconds']:.4f} s vs baseline {stored['seconds']:.4f} s")
+            if result["peak_memory_mb"] > stored["peak_memory_mb"] * (1 + memory_tolerance) + 1:
+                problems.append(f"{key}: peak memory {result['peak_memory_mb']:.1f} MB vs baseline "
+                                f"{stored['peak_memory_mb']:.1f} MB")
+
+        if key in reference:
+            source, expected = "reference", reference[key]
+        elif stored is not None:
+            source, expected = "baseline", stored["fingerprint"]
+        else:
+            continue
+        if result["fingerprint"][0] != expected[0] or \
+                not np.allclose(result["fingerprint"][1:], expected[1:], rtol=rtol, atol=0):
+            problems.append(f"{key}: output {result['fingerprint']} differs from {source} {expected}")
+
+    return problems
+
+
+def get_environment():
+
+    return {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time and peak memory of the EquityCalculator and Sankey paths "
+                                                 "on synthetic data, compared against a stored baseline")
+    parser.add_argument("--preset", choices=list(PRESETS), default="quick")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--memory-tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    baseline_path = os.path.abspath(args.baseline)
+    results = run_benchmarks(PRESETS[args.preset]["units"], PRESETS[args.preset]["resolutions"], args.only,
+                             args.repeats)
+
+    if args.save_baseline:
+        # Timings are replaced, the reference fingerprints of the original methods are kept
+        stored = {"environment": get_environment(), "results": {}}
+        if os.path.exists(baseline_path):
+            with open(baseline_path) as f:
+                previous = json.load(f)
+            stored["results"] = previous["results"]
+            if "reference" in previous:
+                stored["reference"] = previous["reference"]
+        stored["results"].update(results)
+        with open(baseline_path, "w") as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} results to {baseline_path}")
+
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        problems = compare(results, baseline["results"], args.time_tolerance, args.memory_tolerance,
+                           reference=baseline.get("reference", {}).get("fingerprints"))
+        for problem in problems:
+            print("REGRESSION", problem)
+        print(f"{len(problems)} regressions against {baseline_path}")
+        sys.exit(1 if problems else 0)
+
+    else:
+        print(f"No baseline at {baseline_path}; run with --save-baseline to store one")
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+from equity_calculator import EquityCalculator
+from data_loader import hash_workbook
+from results_store import RESULTS_DIR, ResultsStore
+
+
+DATA_PATH = "NCQG Data.xlsx"
+
+# One background thread for the robust sweeps, shared by every session of the process
+_PRECOMPUTE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="robust-precompute")
+
+
+def get_data_version(path=DATA_PATH):
+    """
+    Content hash of the workbook, only re-hashed when its modification time or size changes
+    """
+
+    return hash_workbook(path)
+
+
+@st.cache_resource(max_entries=2, show_spinner="Loading equity data...")
+def _load_calculator(path, data_version):
+
+    return EquityCalculator(data=path, fast_load=True)
+
+
+def get_calculator(path=DATA_PATH):
+    """
+    One EquityCalculator per process, shared across sessions and reloaded only when the workbook changes.
+    The returned object is shared: treat it as read-only.
+    """
+
+    return _load_calculator(path, get_data_version(path))
+
+
+def build_results_store(equity_calculator, data_version, directory=RESULTS_DIR):
+    """
+    Memory-mapped store of every robust run, rebuilt only when it was computed from another data version
+    """
+
+    store = ResultsStore(directory)
+    families = ["allocations"] + ["contributions" + extension for extension in equity_calculator.get_donor_pools()]
+    if not all(store.has(family, data_version) for family in families):
+        store.build(equity_calculator, data_version)
+
+    return store
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def start_results_store(data_version, path=DATA_PATH, directory=RESULTS_DIR):
+    """
+    Start loading (or building) the results store on the background thread, once per data version.
+    Returns a concurrent.futures.Future of the store, so callers can render without waiting for it.
+    """
+
+    return _PRECOMPUTE_EXECUTOR.submit(build_results_store, get_calculator(path), data_version, directory)
+
+
+def get_results_store(data_version, path=DATA_PATH, directory=RESULTS_DIR, timeout=None):
+    """
+    The results store, waiting for the background build if it has not finished. A failed build is
+    forgotten so that the next call starts it again.
+    """
+
+    future = start_results_store(data_version, path, directory)
+    try:
+        return future.result(timeout)
+    except Exception:
+        if future.done():
+            start_results_store.clear()
+        raise
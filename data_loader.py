@@ -0,0 +1,157 @@
+import glob
+import hashlib
+import os
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+IDENTITY_COLUMNS = ["Country", "ISO", "Region"]
+MEMBERSHIP_COLUMNS = ["above_middle_countries", "AnnexII_countries"]
+NULL_PREFIX = "__null__"
+
+
+@lru_cache(maxsize=8)
+def _hash_file(path, modified, size):
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()[:16]
+
+
+def hash_workbook(path):
+    """
+    Content hash of the workbook, only re-hashed when its modification time or size changes
+    """
+
+    stat = os.stat(path)
+    return _hash_file(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def get_cache_path(path, sheet_name, cache_dir=None):
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), ".cache")
+    stem = os.path.splitext(os.path.basename(path))[0]
+
+    return os.path.join(cache_dir, f"{stem}.{sheet_name}.{hash_workbook(path)}.npz")
+
+
+def convert_summary(path, indicator_columns, sheet_name="Summary", cache_dir=None):
+    """
+    Parse the sheet once through openpyxl and store the selected columns as NumPy arrays
+    Inputs:
+        path: Excel workbook
+        indicator_columns: Indicator columns to keep (e.g. the values of EquityCalculator.variable_dict)
+    Returns:
+        cache_path: .npz file keyed on the workbook hash
+    """
+
+    cache_path = get_cache_path(path, sheet_name, cache_dir)
+    columns = IDENTITY_COLUMNS + MEMBERSHIP_COLUMNS + list(dict.fromkeys(indicator_columns))
+    data = pd.read_excel(path, sheet_name=sheet_name, usecols=columns)
+
+    # Fixed dtypes: text identifiers (with a mask of missing values, which str would turn into "nan"),
+    # int8 membership flags and float64 indicators
+    arrays = {column: data[column].fillna("").to_numpy(dtype=str) for column in IDENTITY_COLUMNS}
+    arrays.update({NULL_PREFIX + column: data[column].isna().to_numpy() for column in IDENTITY_COLUMNS})
+    arrays.update({column: data[column].to_numpy(dtype=np.int8) for column in MEMBERSHIP_COLUMNS})
+    arrays.update({column: data[column].to_numpy(dtype=np.float64) for column in dict.fromkeys(indicator_columns)})
+
+    # Remove caches of previous versions of the workbook
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    stem = cache_path.rsplit(".", 2)[0]
+    for stale in glob.glob(glob.escape(stem) + ".*.npz"):
+        os.remove(stale)
+
+    # Write then rename so that concurrent workers never read a partial file
+    temp_path = cache_path + f".{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, __columns__=np.array(columns), **arrays)
+    os.replace(temp_path, cache_path)
+
+    return cache_path
+
+
+def load_summary(path, indicator_columns, sheet_name="Summary", cache_dir=None):
+    """
+    Load the identity, membership and indicator columns of the sheet from the columnar cache,
+    converting the workbook first if it has changed since the cache was built
+    Returns:
+        data: pandas dataframe with one row per country, in workbook order
+    """
+
+    cache_path = get_cache_path(path, sheet_name, cache_dir)
+    columns = IDENTITY_COLUMNS + MEMBERSHIP_COLUMNS + list(dict.fromkeys(indicator_columns))
+
+    # Caches written before the null masks were added are rebuilt
+    required = set(columns) | {NULL_PREFIX + column for column in IDENTITY_COLUMNS}
+    if os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as cached:
+            if required <= set(cached.files):
+                return _read_cached(cached, columns)
+
+    cache_path = convert_summary(path, indicator_columns, sheet_name, cache_dir)
+    with np.load(cache_path, allow_pickle=False) as cached:
+        return _read_cached(cached, columns)
+
+
+def _read_cached(cached, columns):
+
+    data = pd.DataFrame({column: cached[column] for column in columns})
+    for column in IDENTITY_COLUMNS:
+        data[column] = data[column].mask(cached[NULL_PREFIX + column])
+
+    return data
+
+
+def build_unit_table(units, summary, unit_column="Unit"):
+    """
+    Attach each sub-national unit to its country and region (unit -> country -> region)
+    Inputs:
+        units: pandas dataframe with unit_column, the ISO code of each unit's country and the indicator columns
+        summary: Country-level "Summary" dataframe providing Country, Region and the membership flags per ISO
+        unit_column: Column naming each unit
+    Returns:
+        data: pandas dataframe with one row per unit, ordered by country then unit, that EquityCalculator
+            accepts with unit_column set; units inherit their country's Annex II and UMIC/HIC membership
+    """
+
+    if units[unit_column].duplicated().any():
+        raise ValueError(f"Duplicate units in '{unit_column}'")
+
+    countries = summary[IDENTITY_COLUMNS + MEMBERSHIP_COLUMNS].drop_duplicates("ISO")
+    unknown = ~units["ISO"].isin(countries["ISO"])
+    if unknown.any():
+        raise ValueError(f"Units with no country in the summary: {sorted(units.loc[unknown, 'ISO'].unique())[:10]}")
+
+    identity = [column for column in IDENTITY_COLUMNS + MEMBERSHIP_COLUMNS if column != "ISO"]
+    data = units.drop(columns=identity, errors="ignore").merge(countries, on="ISO", how="left", validate="many_to_one")
+    data = data.sort_values(["ISO", unit_column], kind="stable").reset_index(drop=True)
+
+    return data[[unit_column] + IDENTITY_COLUMNS + MEMBERSHIP_COLUMNS +
+                [column for column in units.columns if column not in identity + ["ISO", unit_column]]]
+
+
+if __name__ == "__main__":
+
+    from equity_calculator import EquityCalculator
+
+    path = "NCQG Data.xlsx"
+    EquityCalculator(path, fast_load=True)  # Build the cache
+
+    start = time.perf_counter()
+    EquityCalculator(path)
+    excel_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    EquityCalculator(path, fast_load=True)
+    cached_time = time.perf_counter() - start
+
+    print(f"Excel (openpyxl) load: {excel_time * 1000:.1f} ms")
+    print(f"Columnar cache load:   {cached_time * 1000:.1f} ms ({excel_time / cached_time:.0f}x faster)")
@@ -1,15 +1,43 @@
 import pandas as pd
 import streamlit as st
 import itertools
+import functools
+import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
+from data_loader import load_summary
+from streaming_stats import StreamingStatistics
+from instrumentation import Instrumentation
 import warnings 
 warnings.filterwarnings('ignore')
 
 
 class EquityCalculator:
-    def __init__(self, data):
+    def __init__(self, data, fast_load=False, cache_dir=None, instrumentation=None, unit_column=None,
+                 dtype=np.float64, output_dir=".", writer=None):
+        """
+        Inputs:
+            data: Path to the NCQG Excel workbook, or a "Summary"-shaped pandas dataframe
+            fast_load: If True, load only the identity, membership and indicator columns from a
+                columnar cache of the "Summary" sheet, rebuilt whenever the workbook changes
+            cache_dir: Directory for the columnar cache (defaults to .cache next to the workbook)
+            instrumentation: Optional Instrumentation for progress callbacks, stage timers and profiling
+            unit_column: For sub-national data (see data_loader.build_unit_table), the column naming each
+                unit; every row is then a unit within its Country/ISO and Region rather than a country
+            dtype: Floating point type of the indicator columns and share matrices (np.float32 halves the
+                memory of the robust sweeps over large unit tables)
+            output_dir: Directory of the robust result CSVs
+            writer: Optional output_writer.OutputWriter; robust results are then queued to it as long-format
+                Parquet instead of being written as CSVs
+        """
+
+        self.output_dir = output_dir
+        self.writer = writer
+
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
 
-        self.data = pd.read_excel(data, sheet_name="Summary")
         self.responsibility_dict = {
             "Cumulative Emissions since 1850": "X1850_2024",
             "Cumulative Emissions since 1950": "X1990_2024",
@@ -28,7 +56,23 @@ class EquityCalculator:
             "UN Multilateral Engagement Score": "UN Index"
         }
         self.variable_dict =  {**self.responsibility_dict, **self.capacity_dict, **self.needs_dict, **self.engagement_dict}
+        with self.instrumentation.stage("load"):
+            if isinstance(data, pd.DataFrame):
+                self.data = data.reset_index(drop=True)
+            elif fast_load:
+                self.data = load_summary(data, list(self.variable_dict.values()), sheet_name="Summary", cache_dir=cache_dir)
+            else:
+                self.data = pd.read_excel(data, sheet_name="Summary")
         self.variable_calculations = self.set_variable_calculations()
+
+        # Identity columns carried into every output, finest level first
+        self.unit_column = unit_column
+        self.identity_columns = ([unit_column] if unit_column is not None else []) + ["Country", "ISO", "Region"]
+
+        self.dtype = np.dtype(dtype)
+        if self.dtype != np.float64:
+            indicator_columns = list(dict.fromkeys(self.variable_dict.values()))
+            self.data[indicator_columns] = self.data[indicator_columns].astype(self.dtype)
         
     
     def set_variable_calculations(self):
@@ -69,7 +113,7 @@ class EquityCalculator:
 
         # Get relevant columns
         equity_columns = [self.variable_dict[k] for k in variable_columns]
-        data = data[["Country", "ISO", "Region"] + equity_columns].copy()
+        data = data[self.identity_columns + equity_columns].copy()
 
         # Calculate shares for each equity column
         for variable in variable_columns:
@@ -115,15 +159,8 @@ class EquityCalculator:
 
         """
 
-        # Get relevant data
-        if include_UMIC == True:
-            selected_data = self.data.loc[self.data["above_middle_countries"] == 1]
-        else:
-            selected_data = self.data.loc[self.data["AnnexII_countries"] == 1]
-
-        # Remove US if specified
-        if exclude_US is True:
-            selected_data = selected_data.loc[selected_data["ISO"] != "USA"]
+        # Get relevant data, removing the US if specified
+        selected_data = self.data.loc[self.get_donor_pool(include_UMIC, exclude_US)]
         
         # Remove needs and engagement from the calculation
         responsibility = weights.get("Responsibility")
@@ -133,7 +170,7 @@ class EquityCalculator:
 
          # Get relevant columns
         equity_columns = [self.variable_dict.get(k) for k in variable_columns]
-        data = selected_data[["Country", "ISO", "Region"] + equity_columns].copy()
+        data = selected_data[self.identity_columns + equity_columns].copy()
 
         # Calculate contributions
         for i, variable in enumerate(variable_columns):
@@ -155,6 +192,90 @@ class EquityCalculator:
 
         return data
     
+    def get_batch_inputs(self, weights, variable_columns, n_pillars=4):
+        """
+        Weight matrix and share-matrix column positions for a batch of weightings
+        Inputs:
+            weights: numpy array (N x 4) in pillar order, or a list of N weight dictionaries
+            variable_columns: One list of selected variable names per pillar for every weighting, or N such lists
+        Returns:
+            weights: numpy array (N x n_pillars)
+            columns: numpy array (N x n_pillars) of positions in normalise_indicators
+        """
+
+        if isinstance(weights, np.ndarray):
+            weights = weights.astype(float).reshape(len(weights), -1)
+        elif n_pillars == 4:
+            weights = np.array([list(w.values()) for w in weights], dtype=float)
+        else:
+            weights = np.array([[w.get("Responsibility"), w.get("Capacity")] for w in weights], dtype=float)
+        weights = weights[:, :n_pillars]
+
+        positions = {variable: i for i, variable in enumerate(self.variable_dict)}
+        if isinstance(variable_columns[0], str):
+            variable_columns = [variable_columns]
+        columns = np.array([[positions[v] for v in selection[:n_pillars]] for selection in variable_columns])
+        columns = np.broadcast_to(columns, weights.shape)
+
+        return weights, columns
+
+    @staticmethod
+    def combine_batch(shares, weights, columns, value):
+        """
+        Weighted sum of the selected share columns for every weighting, accumulated pillar by pillar
+        in the same order as the DataFrame methods so that results match them exactly
+        Returns:
+            values: numpy array (N x countries)
+        """
+
+        shares = np.where(np.isnan(shares), 0.0, shares)
+        total = np.zeros((len(weights), shares.shape[0]))
+        for p in range(weights.shape[1]):
+            total = total + shares[:, columns[:, p]].T * weights[:, p:p + 1]
+
+        total = total / weights.sum(axis=1)[:, None]
+
+        return total * np.asarray(value, dtype=float).reshape(-1, 1)
+
+    def calculate_weighted_equity_batch(self, weights, variable_columns, value):
+        """
+        Allocations for many weightings at once, as calculate_weighted_equity would give one by one
+        Inputs:
+            weights: numpy array (N x 4) of Responsibility, Capacity, Needs and Engagement weights, or a list of
+                N weight dictionaries
+            variable_columns: List of selected variable names (one per pillar) shared by every weighting,
+                or a list of N such lists
+            value: Total climate finance value (USDbn), or an array of N totals
+        Returns:
+            allocations: numpy array (N x recipients) of Allocation_USDbn, with recipients in the row order of
+                calculate_weighted_equity
+        """
+
+        data = self.data.loc[self.data["AnnexII_countries"]==0]
+        weights, columns = self.get_batch_inputs(weights, variable_columns)
+
+        return self.combine_batch(self.normalise_indicators(data), weights, columns, value)
+
+    def calculate_contributions_batch(self, weights, variable_columns, total_value, include_UMIC=None,
+                                      exclude_US=None):
+        """
+        Contributions for many weightings at once, as calculate_contributions would give one by one
+        Inputs:
+            weights: numpy array (N x 4) or (N x 2) whose first two columns are the Responsibility and Capacity
+                weights, or a list of N weight dictionaries
+            variable_columns: List of selected variable names shared by every weighting, or a list of N such lists;
+                only the first two (Responsibility and Capacity) are used
+            total_value: Total climate finance value (USDbn), or an array of N totals
+        Returns:
+            contributions: numpy array (N x donors) of Contributions_USDbn, with donors in the row order of
+                calculate_contributions
+        """
+
+        data = self.data.loc[self.get_donor_pool(include_UMIC, exclude_US)]
+        weights, columns = self.get_batch_inputs(weights, variable_columns, n_pillars=2)
+
+        return self.combine_batch(self.normalise_indicators(data, contributions=True), weights, columns, total_value)
+
     def aggregate_to_regions(self, data):
 
         # Aggregate to regions
@@ -169,175 +290,321 @@ class EquityCalculator:
         # Return data
         return region_data
 
-    
+    def roll_up(self, data, level="Country", value_columns=None):
+        """
+        Sum unit-level results up to their country or region without re-running them
+        Inputs:
+            data: Output of any method over rows of self.data, with the identity columns
+            level: "Country" (grouped by Country, ISO and Region) or "Region"
+            value_columns: Columns to sum; defaults to every share, score, allocation and contribution
+                column (shares are additive, so rolled-up Robust_Share columns equal the mean over runs of
+                the country totals; standard errors and quantiles are not additive and are left out)
+        Returns:
+            rolled: pandas dataframe with one row per country or region
+        """
+
+        keys = {"Country": ["Country", "ISO", "Region"], "Region": ["Region"]}.get(level)
+        if keys is None:
+            raise ValueError(f"Unknown level '{level}'; expected 'Country' or 'Region'")
+
+        if value_columns is None:
+            value_columns = [column for column in data.columns
+                             if (column.startswith(("Share_", "Robust_")) and not column.endswith("_SE"))
+                             or column.endswith(("_share", "_contribution", "_Score", "_USDbn"))]
+
+        return data.groupby(keys, sort=False)[value_columns].sum(min_count=1).reset_index()
 
-    def calculate_robust_allocation(self):
-        
-        def generate_positive_weight_combos():
-            k_values = range(1, 11)  # 1..5 => weights 0.2..1.0
-            combos = []
-            for k_resp, k_cap, k_need, k_eng in itertools.product(k_values, repeat=4):
-                if k_resp + k_cap + k_need + k_eng == 10:
-                    weights = np.array([k_resp, k_cap, k_need, k_eng]) / 10.0
-                    combos.append(weights)
-            return combos
     
 
-        data = self.data.loc[self.data["AnnexII_countries"]==0].copy()
-        weight_combos = generate_positive_weight_combos()
-        iteration = 0 
-        summary_dict = {} 
-        for (resp_name, resp_col), (cap_name, cap_col), (need_name, need_col), (eng_name, eng_col) \
-            in itertools.product(self.responsibility_dict.items(),
-            self.capacity_dict.items(),
-            self.needs_dict.items(),
-            self.engagement_dict.items()):
-            
-            variable_columns = [resp_name, cap_name, need_name, eng_name]
-            equity_columns = [resp_col, cap_col, need_col, eng_col]
-            
-            for weights in weight_combos:
+    def normalise_indicators(self, data, contributions=False, masks=None):
+        """
+        Normalise every indicator in variable_dict once into a share matrix
+        Inputs:
+            data: pandas dataframe with the indicator columns for the selected countries
+            contributions: If True, invert the basis as in calculate_contributions
+            masks: Optional boolean array (pools x countries); shares are renormalised within each pool
+        Returns:
+            shares: numpy array (countries x indicators), ordered as variable_dict, or
+                (pools x countries x indicators) if masks are given, with NaN outside each pool
+        """
 
-                
-                iteration += 1
-                iter_name = f"RUN{iteration}" 
+        # Indicators x countries, so that every indicator is summed as one contiguous row as pandas does
+        values = data[list(self.variable_dict.values())].to_numpy(dtype=self.dtype).T
+        transformed = np.empty_like(values, order="C")
 
-                for variable in variable_columns:
-                    column = self.variable_dict[variable]
-                    data = self.calculate_share(data, column, variable)
-        
-                # Calculate weighted equity score
-                data["Weighted_equity_share"] = data[[col + "_share" for col in equity_columns]]\
-                    .multiply(weights).sum(axis=1) \
-                        / sum(weights)
-                print(f"Completed iteration {iteration}")
-
-                # Calculate allocations
-                data["Share_"+iter_name] = data["Weighted_equity_share"]
-
-                # Drop all intermediate columns
-                data = data.drop(columns=[col for col in data.columns if col.endswith("_share")])
-
-                # Store parameters
-                summary_dict[iter_name] = {
-        "responsibility_metric": resp_name,
-        "responsibility_column": resp_col,
-        "w_responsibility": weights[0],
-
-        "capacity_metric": cap_name,
-        "capacity_column": cap_col,
-        "w_capacity": weights[1],
-
-        "needs_metric": need_name,
-        "needs_column": need_col,
-        "w_needs": weights[2],
-
-        "engagement_metric": eng_name,
-        "engagement_column": eng_col,
-        "w_engagement": weights[3]}
-                    
-        # Calculate average share across all iterations
-        data["Robust_Share"] = data[[col for col in data.columns if col.startswith("Share_RUN")]].mean(axis=1)
-        summary_df = pd.DataFrame.from_dict(summary_dict, orient="index")
+        for i, variable in enumerate(self.variable_dict):
+            basis = self.variable_calculations.get(variable)
+            if contributions:
+                basis = {"positive": "negative", "negative": "positive"}.get(basis)
 
-        # Scale robust share to ensure that it is the share of the total
-        data["Robust_Share"] = data["Robust_Share"] / data["Robust_Share"].sum() 
+            with np.errstate(divide="ignore"):
+                if basis == "positive":
+                    transformed[i] = values[i]
+                elif basis == "negative":
+                    transformed[i] = 1 / values[i]
+                else:
+                    raise ValueError("No valid basis found in the mapping")
 
-        # Save file
-        summary_df.to_csv("Allocation_Runs.csv")
-        data.to_csv("Robust_Allocations_NCQG.csv")
+        if masks is not None:
+            transformed = np.where(np.asarray(masks, dtype=bool)[:, None, :], transformed, np.nan)
 
+        # Calculate shares, skipping missing values as pandas does
+        with np.errstate(invalid="ignore"):
+            return np.swapaxes(transformed / np.nansum(transformed, axis=-1, keepdims=True), -1, -2)
 
-        return data, summary_df
+    def get_metric_combinations(self):
+        """
+        Enumerate every (responsibility, capacity, needs, engagement) metric choice
+        Returns:
+            names: numpy array (metric combos x 4) of selected variable names
+            index: numpy array (metric combos x 4) of column positions in normalise_indicators
+        """
 
+        positions = {variable: i for i, variable in enumerate(self.variable_dict)}
+        names = list(itertools.product(self.responsibility_dict,
+            self.capacity_dict,
+            self.needs_dict,
+            self.engagement_dict))
+        index = np.array([[positions[name] for name in combo] for combo in names])
 
-    def calculate_robust_contributions(self, include_UMIC=None, exclude_US=None):
+        return np.array(names, dtype=object), index
 
-        def generate_positive_weight_combos():
-            k_values = range(1, 11)  # 1..5 => weights 0.2..1.0
-            combos = []
-            for k_resp, k_cap, k_need, k_eng in itertools.product(k_values, repeat=4):
-                if k_resp + k_cap + k_need + k_eng == 10:
-                    weights = np.array([k_resp, k_cap, k_need, k_eng]) / 10.0
-                    combos.append(weights)
-            return combos
-        
-        # Get relevant data
-        if include_UMIC == True:
-            selected_data = self.data.loc[self.data["above_middle_countries"] == 1]
-        else:
-            selected_data = self.data.loc[self.data["AnnexII_countries"] == 1]
+    @staticmethod
+    def calculate_run_shares(shares, metric_index, weight_combos):
+        """
+        Calculate the weighted share of every run as one batched matrix product
+        Inputs:
+            shares: numpy array (countries x indicators) or (pools x countries x indicators) from normalise_indicators
+            metric_index: numpy array (metric combos x 4) from get_metric_combinations
+            weight_combos: numpy array (weight combos x 4)
+        Returns:
+            runs: numpy array (runs x countries), or (pools x runs x countries), ordered metric combo
+                first then weights, as RUN1..RUNn
+        """
 
-        # Remove US if specified
-        if exclude_US is True:
-            selected_data = selected_data.loc[selected_data["ISO"] != "USA"]
-        data = selected_data.copy()
-
-        weight_combos = generate_positive_weight_combos()
-        iteration = 0 
-        summary_dict = {} 
-        for (resp_name, resp_col), (cap_name, cap_col), (need_name, need_col), (eng_name, eng_col) \
-            in itertools.product(self.responsibility_dict.items(),
-            self.capacity_dict.items(),
-            self.needs_dict.items(),
-            self.engagement_dict.items()):
-            
-            variable_columns = [resp_name, cap_name, need_name, eng_name]
-            equity_columns = [resp_col, cap_col, need_col, eng_col]
-            for weights in weight_combos:
-                
-                iteration += 1
-                iter_name = f"RUN{iteration}"
-
-                for i, variable in enumerate(variable_columns):
-                    column = self.variable_dict.get(variable)
-                    basis = self.variable_calculations.get(variable)
-                    
-                    if basis == "positive":
-                        data[column + "_contribution"] = (1/data[column]) / (1/data[column]).sum()
-                    elif basis == "negative":
-                        data[column + "_contribution"] = data[column] / data[column].sum()  
-        
-                
-                
-                # Calculate weighted equity score
-                data["Weighted_Contributions_Score"] = data[[col + "_contribution" for col in equity_columns]]\
-            .multiply(weights).sum(axis=1) \
-                / sum(weights)
-                print(f"Completed iteration {iteration}")
+        weight_combos = np.asarray(weight_combos, dtype=shares.dtype)
 
-                # Calculate allocations
-                data["Share_"+iter_name] = data["Weighted_Contributions_Score"]
+        # Missing shares drop out of the weighted sum
+        selected = np.moveaxis(shares[..., metric_index], -3, -2)
+        selected = np.where(np.isnan(selected), 0.0, selected)
 
-                # Drop all intermediate columns
-                data = data.drop(columns=[col for col in data.columns if col.endswith("_share")])
+        # (metric combos x countries x 4) @ (4 x weight combos)
+        runs = (selected @ weight_combos.T) / weight_combos.sum(axis=1)
+        runs = np.swapaxes(runs, -1, -2)
 
-                # Store parameters
-                summary_dict[iter_name] = {
-        "responsibility_metric": resp_name,
-        "responsibility_column": resp_col,
-        "w_responsibility": weights[0],
+        return runs.reshape(*runs.shape[:-3], -1, shares.shape[-2])
 
-        "capacity_metric": cap_name,
-        "capacity_column": cap_col,
-        "w_capacity": weights[1],
+    def summarise_runs(self, metric_names, weight_combos):
+        """
+        Build the parameter table describing every run
+        Returns:
+            summary_df: pandas dataframe indexed RUN1..RUNn with metric, column and weight per pillar
+        """
 
-        "needs_metric": need_name,
-        "needs_column": need_col,
-        "w_needs": weights[2],
+        n_metrics, n_weights = len(metric_names), len(weight_combos)
+        summary = {}
+        for p, pillar in enumerate(["responsibility", "capacity", "needs", "engagement"]):
+            pillar_names = np.repeat(metric_names[:, p], n_weights)
+            summary[pillar + "_metric"] = pillar_names
+            summary[pillar + "_column"] = [self.variable_dict[name] for name in pillar_names]
+            summary["w_" + pillar] = np.tile(weight_combos[:, p], n_metrics)
 
-        "engagement_metric": eng_name,
-        "engagement_column": eng_col,
-        "w_engagement": weights[3]}
-                    
-        # Calculate average share across all iterations
-        data["Robust_Contribution"] = data[[col for col in data.columns if col.startswith("Share_RUN")]].mean(axis=1)
-        summary_df = pd.DataFrame.from_dict(summary_dict, orient="index")
+        index = [f"RUN{i}" for i in range(1, n_metrics * n_weights + 1)]
 
-        # Scale the average share to ensure that it is 1
-        data["Robust_Contribution"] = data["Robust_Contribution"] / data["Robust_Contribution"].sum()
+        return pd.DataFrame(summary, index=index)
+
+    def accumulate_run_statistics(self, shares, metric_index, resolution=10, allow_zero=False, batch_size=10000,
+                                  masks=None, backend="serial", max_workers=None):
+        """
+        Stream every run through a StreamingStatistics accumulator one batch of weights at a time,
+        without storing the (runs x countries) matrix
+        Inputs:
+            shares: numpy array (countries x indicators) or (pools x countries x indicators)
+            metric_index: numpy array (metric combos x 4) from get_metric_combinations
+            resolution, allow_zero: Weight grid passed to iter_weight_combos
+            batch_size: Maximum number of weight combinations per batch
+            masks: Optional boolean array (pools x countries); runs outside each pool are skipped
+            backend: "serial", "threads" or "processes"; see run_parallel_sweep
+            max_workers: Number of workers for the threads and processes backends
+        Returns:
+            stats: StreamingStatistics over countries, or (pools x countries)
+        """
+
+        if backend != "serial":
+            weight_combos = generate_weight_combos(resolution, allow_zero=allow_zero)
+            return run_parallel_sweep(shares, metric_index, weight_combos, masks, batch_size, backend, max_workers,
+                                      progress=self.instrumentation.progress)
+
+        stats = StreamingStatistics(shares.shape[:-1])
+        batch_size = get_batch_size(batch_size, shares)
+        n_batches = -(-count_weight_combos(resolution, allow_zero=allow_zero) // batch_size)
+        total, done = len(metric_index) * n_batches, 0
+        for m in range(len(metric_index)):
+            for weight_combos in iter_weight_combos(resolution, allow_zero=allow_zero, chunk_size=batch_size):
+                runs = self.calculate_run_shares(shares, metric_index[m:m + 1], weight_combos)
+                if masks is not None:
+                    runs = np.where(masks[:, None, :], runs, np.nan)
+                stats.update(np.moveaxis(runs, -2, 0))
+                done += 1
+                self.instrumentation.progress(done, total, "combine")
+
+        return stats
+
+    def sample_run_statistics(self, shares, metric_index, tolerance=1e-3, batch_size=10000, max_samples=200000,
+                              alpha=1.0, seed=None, masks=None):
+        """
+        Monte Carlo alternative to the weight grid: draw runs in batches until every country's
+        mean share has a standard error below the tolerance
+        Inputs:
+            shares: numpy array (countries x indicators) or (pools x countries x indicators)
+            metric_index: numpy array (metric combos x 4); each run picks one combination uniformly
+            tolerance: Target standard error of every country's mean share
+            batch_size: Runs drawn per batch
+            max_samples: Stop after this many runs even if the tolerance is not reached
+            alpha: Dirichlet concentration for the weights (1.0 samples the simplex uniformly)
+            seed: Random seed
+            masks: Optional boolean array (pools x countries); runs outside each pool are skipped
+        Returns:
+            stats: StreamingStatistics over countries, or (pools x countries)
+            report: Dictionary with the samples used, the achieved (maximum) standard error and convergence
+        """
+
+        rng = np.random.default_rng(seed)
+        alpha = np.broadcast_to(np.asarray(alpha, dtype=float), (metric_index.shape[1],))
+        stats = StreamingStatistics(shares.shape[:-1])
+        batch_size = get_batch_size(batch_size, shares)
+
+        samples, standard_error = 0, np.inf
+        while samples < max_samples and not standard_error < tolerance:
+            size = min(batch_size, max_samples - samples)
+            metrics = rng.integers(len(metric_index), size=size)
+            weights = rng.dirichlet(alpha, size=size).astype(shares.dtype)
+
+            # (... x countries x runs x 4) weighted by (runs x 4)
+            selected = shares[..., metric_index[metrics]]
+            selected = np.where(np.isnan(selected), 0.0, selected)
+            runs = np.einsum("...crk,rk->...rc", selected, weights) / weights.sum(axis=1)[:, None]
+            if masks is not None:
+                runs = np.where(masks[:, None, :], runs, np.nan)
+            stats.update(np.moveaxis(runs, -2, 0))
+
+            samples += size
+            standard_error = np.nanmax(stats.standard_error) if samples > 1 else np.inf
+            self.instrumentation.progress(samples, max_samples, "combine")
+
+        report = {
+            "samples": samples,
+            "standard_error": float(standard_error),
+            "tolerance": tolerance,
+            "converged": bool(standard_error < tolerance),
+        }
+
+        return stats, report
+
+    def calculate_robust_allocation(self, resolution=10, allow_zero=False, streaming=False, batch_size=10000,
+                                    method="grid", tolerance=1e-3, max_samples=200000, alpha=1.0, seed=None,
+                                    backend="serial", max_workers=None):
+        """
+        Average the allocation shares over every metric combination and weight combination
+        Inputs:
+            resolution, allow_zero: Weight grid passed to generate_weight_combos
+            streaming: If True, accumulate per-country statistics batch by batch instead of keeping every run
+            batch_size: Weight combinations (or Monte Carlo samples) per batch
+            method: "grid" for the full weight grid or "monte_carlo" to sample until converged;
+                see sample_run_statistics for tolerance, max_samples, alpha and seed
+            backend, max_workers: Execution backend for streaming sweeps ("serial", "threads" or "processes")
+        Returns:
+            data: Recipient dataframe with Share_RUN columns and Robust_Share (Robust_Share only when streaming;
+                plus Robust_Share_SE and a data.attrs["sampling"] report for monte_carlo)
+            summary_df: Parameters of each run, or a StreamingStatistics accumulator when streaming or sampling
+        """
         
+        data = self.data.loc[self.data["AnnexII_countries"]==0].copy()
+
+        # Normalise each indicator once, then weight all runs together
+        with self.instrumentation.stage("normalise"):
+            shares = self.normalise_indicators(data)
+            metric_names, metric_index = self.get_metric_combinations()
+
+        if method == "monte_carlo":
+            with self.instrumentation.stage("combine"):
+                stats, report = self.sample_run_statistics(shares, metric_index, tolerance, batch_size, max_samples,
+                                                           alpha, seed)
+            with self.instrumentation.stage("aggregate"):
+                data["Robust_Share"] = stats.mean / np.nansum(stats.mean)
+                data["Robust_Share_SE"] = stats.standard_error
+                data.attrs["sampling"] = report
+
+            return data, stats
+
+        if streaming:
+            with self.instrumentation.stage("combine"):
+                stats = self.accumulate_run_statistics(shares, metric_index, resolution, allow_zero, batch_size,
+                                                       backend=backend, max_workers=max_workers)
+            with self.instrumentation.stage("aggregate"):
+                data["Robust_Share"] = stats.mean / np.nansum(stats.mean)
+            self.write_results("allocations", data, "Robust_Allocations_NCQG.csv")
+
+            return data, stats
+
+        with self.instrumentation.stage("combine"):
+            weight_combos = generate_weight_combos(resolution, allow_zero=allow_zero)
+            runs = self.calculate_run_shares(shares, metric_index, weight_combos)
+            self.instrumentation.progress(1, 1, "combine")
+
+        with self.instrumentation.stage("aggregate"):
+            summary_df = self.summarise_runs(metric_names, weight_combos)
+
+            # Attach the runs in one step rather than column by column
+            run_columns = pd.DataFrame(runs.T, index=data.index, columns=["Share_" + name for name in summary_df.index])
+            data = pd.concat([data, run_columns], axis=1)
+
+            # Calculate average share across all iterations
+            data["Robust_Share"] = runs.mean(axis=0)
+
+            # Scale robust share to ensure that it is the share of the total
+            data["Robust_Share"] = data["Robust_Share"] / data["Robust_Share"].sum() 
+
         # Save file
+        self.write_results("allocations", data, "Robust_Allocations_NCQG.csv", runs, summary_df, "Allocation_Runs.csv")
+
+
+        return data, summary_df
+
+
+    def write_results(self, scenario, data, filename, runs=None, summary_df=None, summary_filename=None):
+        """
+        Save one scenario's robust results: queued to self.writer as long-format Parquet when one is set,
+        otherwise as the wide CSVs (and run parameters) in output_dir
+        """
+
+        with self.instrumentation.stage("write"):
+            if self.writer is not None:
+                self.writer.write_scenario(scenario, data, runs, summary_df, key_column=self.unit_column or "ISO")
+                return
+
+            os.makedirs(self.output_dir, exist_ok=True)
+            if summary_df is not None:
+                summary_df.to_csv(os.path.join(self.output_dir, summary_filename))
+            data.to_csv(os.path.join(self.output_dir, filename))
+
+    def get_donor_pool(self, include_UMIC=None, exclude_US=None):
+        """
+        Boolean mask over self.data for Annex II or all UMIC/HIC contributors, optionally without the USA
+        """
+
+        if include_UMIC == True:
+            mask = self.data["above_middle_countries"] == 1
+        else:
+            mask = self.data["AnnexII_countries"] == 1
+
+        if exclude_US is True:
+            mask = mask & (self.data["ISO"] != "USA")
+
+        return mask.to_numpy()
+
+    def get_donor_pool_extension(self, include_UMIC=None, exclude_US=None):
+
         if (include_UMIC == True) and (exclude_US == True):
             extension = "_UMIC"
         elif (include_UMIC == True) and (exclude_US == False):
@@ -346,9 +613,306 @@ class EquityCalculator:
             extension = ""
         else:
             extension = "_US"
-        summary_df.to_csv("Contributions_summary" + extension + ".csv")
-        data.to_csv("Robust_Contributions_NCQG" + extension + ".csv")
 
+        return extension
 
-        return data, summary_df
+    def get_donor_pools(self):
+        """
+        The four donor-pool scenarios read by postprocessor.Data, keyed by file extension
+        """
+
+        pools = {}
+        for include_UMIC, exclude_US in [(False, True), (False, False), (True, True), (True, False)]:
+            extension = self.get_donor_pool_extension(include_UMIC, exclude_US)
+            pools[extension] = self.get_donor_pool(include_UMIC, exclude_US)
+
+        return pools
+
+    def calculate_robust_contributions_pools(self, masks=None, extensions=None, resolution=10, allow_zero=False,
+                                             streaming=False, batch_size=10000, method="grid", tolerance=1e-3,
+                                             max_samples=200000, alpha=1.0, seed=None, backend="serial",
+                                             max_workers=None):
+        """
+        Calculate robust contributions for several donor pools in one batched sweep
+        Inputs:
+            masks: List of boolean masks over self.data, one per donor pool. Defaults to get_donor_pools()
+            extensions: File extension per pool for Robust_Contributions_NCQG{ext}.csv and
+                Contributions_summary{ext}.csv. If None, nothing is written
+            resolution, allow_zero: Weight grid passed to generate_weight_combos
+            streaming: If True, accumulate per-country statistics batch by batch instead of keeping every run
+            batch_size: Weight combinations (or Monte Carlo samples) per batch
+            method: "grid" for the full weight grid or "monte_carlo" to sample until converged;
+                see sample_run_statistics for tolerance, max_samples, alpha and seed
+            backend, max_workers: Execution backend for streaming sweeps ("serial", "threads" or "processes")
+        Returns:
+            frames: List of per-pool dataframes, as returned by calculate_robust_contributions
+            runs: numpy array (pools x runs x countries) over self.data rows, NaN outside each pool
+            summary_df: pandas dataframe with the parameters of each run
+            When streaming or sampling, returns (frames, stats) instead, where frames hold Robust_Contribution
+            (plus Robust_Contribution_SE and a frame.attrs["sampling"] report for monte_carlo) and stats is a
+            (pools x countries) StreamingStatistics over self.data rows
+        """
+
+        if masks is None:
+            pools = self.get_donor_pools()
+            masks = list(pools.values())
+            extensions = list(pools.keys())
+        masks = np.array(masks, dtype=bool).reshape(-1, len(self.data))
+
+        # Renormalise each indicator within every pool, then weight all pools and runs together
+        with self.instrumentation.stage("normalise"):
+            shares = self.normalise_indicators(self.data, contributions=True, masks=masks)
+            metric_names, metric_index = self.get_metric_combinations()
+
+        if method == "monte_carlo" or streaming:
+            with self.instrumentation.stage("combine"):
+                if method == "monte_carlo":
+                    stats, report = self.sample_run_statistics(shares, metric_index, tolerance, batch_size,
+                                                               max_samples, alpha, seed, masks)
+                else:
+                    stats = self.accumulate_run_statistics(shares, metric_index, resolution, allow_zero, batch_size,
+                                                           masks, backend, max_workers)
+
+            frames = []
+            for p, mask in enumerate(masks):
+                with self.instrumentation.stage("aggregate"):
+                    data = self.data.loc[mask].copy()
+                    data["Robust_Contribution"] = stats.mean[p][mask] / np.nansum(stats.mean[p][mask])
+                    if method == "monte_carlo":
+                        data["Robust_Contribution_SE"] = stats.standard_error[p][mask]
+                        data.attrs["sampling"] = report
+                    frames.append(data)
+                if extensions is not None and method != "monte_carlo":
+                    self.write_results("contributions" + extensions[p], data,
+                                       "Robust_Contributions_NCQG" + extensions[p] + ".csv")
+
+            return frames, stats
+
+        with self.instrumentation.stage("combine"):
+            weight_combos = generate_weight_combos(resolution, allow_zero=allow_zero)
+            runs = self.calculate_run_shares(shares, metric_index, weight_combos)
+            runs = np.where(masks[:, None, :], runs, np.nan)
+            self.instrumentation.progress(1, 1, "combine")
+
+        with self.instrumentation.stage("aggregate"):
+            summary_df = self.summarise_runs(metric_names, weight_combos)
+
+        frames = []
+        for p, mask in enumerate(masks):
+            with self.instrumentation.stage("aggregate"):
+                data = self.build_robust_contributions_frame(self.data.loc[mask].copy(), shares[p][mask],
+                                                             runs[p][:, mask], metric_names, summary_df)
+                frames.append(data)
+
+            # Save file
+            if extensions is not None:
+                self.write_results("contributions" + extensions[p], data,
+                                   "Robust_Contributions_NCQG" + extensions[p] + ".csv", runs[p][:, mask],
+                                   summary_df, "Contributions_summary" + extensions[p] + ".csv")
+
+        return frames, runs, summary_df
+
+    def build_robust_contributions_frame(self, data, shares, runs, metric_names, summary_df):
+        """
+        Lay out one donor pool's runs with the same columns, in the same order, as the original per-run loop
+        """
+
+        columns = {}
+        positions = {variable: i for i, variable in enumerate(self.variable_dict)}
+        n_weights = len(summary_df) // len(metric_names)
+        for m, combo in enumerate(metric_names):
+            for variable in combo:
+                columns.setdefault(self.variable_dict[variable] + "_contribution", shares[:, positions[variable]])
+            columns.setdefault("Weighted_Contributions_Score", runs[-1])
+            for run in range(m * n_weights, (m + 1) * n_weights):
+                columns["Share_" + summary_df.index[run]] = runs[run]
+
+        data = pd.concat([data, pd.DataFrame(columns, index=data.index)], axis=1)
+
+        # Calculate average share across all iterations
+        data["Robust_Contribution"] = runs.mean(axis=0)
+
+        # Scale the average share to ensure that it is 1
+        data["Robust_Contribution"] = data["Robust_Contribution"] / data["Robust_Contribution"].sum()
+
+        return data
+
+    def calculate_robust_contributions(self, include_UMIC=None, exclude_US=None, resolution=10, allow_zero=False,
+                                       streaming=False, batch_size=10000, method="grid", tolerance=1e-3,
+                                       max_samples=200000, alpha=1.0, seed=None, backend="serial",
+                                       max_workers=None):
+        """
+        Robust contributions for one donor pool; see calculate_robust_contributions_pools.
+        When streaming or sampling, the second return value is a (1 x countries) StreamingStatistics over self.data rows.
+        """
+
+        mask = self.get_donor_pool(include_UMIC, exclude_US)
+        extension = self.get_donor_pool_extension(include_UMIC, exclude_US)
+        result = self.calculate_robust_contributions_pools([mask], [extension], resolution, allow_zero,
+                                                           streaming, batch_size, method, tolerance,
+                                                           max_samples, alpha, seed, backend, max_workers)
+
+        return result[0][0], result[-1]
+
+
+# Largest (pools x runs x countries x 4) intermediate of one batch; caps the runs per batch on large unit tables
+MAX_BATCH_ELEMENTS = 1 << 26
+
+
+def get_batch_size(batch_size, shares, max_elements=MAX_BATCH_ELEMENTS):
+    """
+    Runs per batch, reduced so that one batch over every pool and country stays below max_elements
+    """
+
+    per_run = int(np.prod(shares.shape[:-1])) * 4
+
+    return max(1, min(batch_size, max_elements // per_run))
+
+
+def count_weight_combos(resolution=10, n_pillars=4, allow_zero=False):
+    """
+    Number of lattice points on the weight simplex for the given resolution
+    """
+
+    free = resolution if allow_zero else resolution - n_pillars
+    if free < 0:
+        return 0
+
+    return math.comb(free + n_pillars - 1, n_pillars - 1)
+
+
+def iter_weight_combos(resolution=10, n_pillars=4, allow_zero=False, chunk_size=100000):
+    """
+    Yield the lattice points of the weight simplex in chunks, without rejection sampling
+
+    Each point is a composition k_1 + ... + k_n = resolution (k_i >= 1 unless allow_zero),
+    enumerated by stars and bars in the same lexicographic order as itertools.product.
+    Inputs:
+        resolution: Number of steps on each axis (10 => steps of 0.1, 100 => steps of 0.01)
+        n_pillars: Number of weights per combination
+        allow_zero: If True, allow a weight of zero
+        chunk_size: Maximum number of combinations per chunk
+    Yields:
+        weights: numpy array (chunk x n_pillars) of weights summing to 1
+    """
+
+    offset = 0 if allow_zero else 1
+    free = resolution - n_pillars * offset
+    if free < 0:
+        return
+    if n_pillars == 1:
+        yield np.ones((1, 1))
+        return
 
+    # Bar positions among free stars and n_pillars - 1 bars
+    bars = itertools.combinations(range(free + n_pillars - 1), n_pillars - 1)
+    remaining = count_weight_combos(resolution, n_pillars, allow_zero)
+    while remaining > 0:
+        count = min(chunk_size, remaining)
+        positions = np.fromiter(itertools.chain.from_iterable(itertools.islice(bars, count)),
+                                dtype=np.int64, count=count * (n_pillars - 1)).reshape(count, n_pillars - 1)
+        remaining -= count
+
+        # Gaps between consecutive bars are the parts of the composition
+        edges = np.column_stack([np.full(count, -1), positions, np.full(count, free + n_pillars - 1)])
+        yield (np.diff(edges, axis=1) - 1 + offset) / resolution
+
+
+def generate_weight_combos(resolution=10, n_pillars=4, allow_zero=False):
+    """
+    All lattice points of the weight simplex as one contiguous (combinations x n_pillars) array.
+    See iter_weight_combos; the default grid is the 84 strictly positive 0.1-step combinations.
+    """
+
+    chunks = list(iter_weight_combos(resolution, n_pillars, allow_zero,
+                                     chunk_size=max(count_weight_combos(resolution, n_pillars, allow_zero), 1)))
+    if not chunks:
+        return np.empty((0, n_pillars))
+
+    return np.ascontiguousarray(np.concatenate(chunks))
+
+
+# Arrays shared with sweep workers, memory-mapped once per worker process
+_SWEEP_ARRAYS = {}
+
+
+def _attach_sweep_arrays(paths):
+
+    for key, path in paths.items():
+        _SWEEP_ARRAYS[key] = np.load(path, mmap_mode="r")
+
+
+def _sweep_task(task, arrays=None):
+
+    arrays = _SWEEP_ARRAYS if arrays is None else arrays
+    shares, metric_index, weight_combos = arrays["shares"], arrays["metric_index"], arrays["weight_combos"]
+    masks = arrays.get("masks")
+    m_start, m_stop, w_start, w_stop = task
+
+    stats = StreamingStatistics(shares.shape[:-1])
+    for m in range(m_start, m_stop):
+        runs = EquityCalculator.calculate_run_shares(shares, metric_index[m:m + 1], weight_combos[w_start:w_stop])
+        if masks is not None:
+            runs = np.where(masks[:, None, :], runs, np.nan)
+        stats.update(np.moveaxis(runs, -2, 0))
+
+    return stats
+
+
+def run_parallel_sweep(shares, metric_index, weight_combos, masks=None, batch_size=10000, backend="processes",
+                       max_workers=None, progress=None):
+    """
+    Split a robust sweep into (metric combination x weight batch) tasks, run them on a pool of workers
+    and merge the partial statistics
+    Inputs:
+        shares: numpy array (countries x indicators) or (pools x countries x indicators)
+        metric_index: numpy array (metric combos x 4)
+        weight_combos: numpy array (weight combos x 4)
+        masks: Optional boolean array (pools x countries)
+        batch_size: Weight combinations per task (capped by get_batch_size)
+        backend: "threads" shares the arrays directly; "processes" writes them once to .npy files that
+            every worker memory-maps at start-up, so no task pickles the indicator matrix
+        max_workers: Number of workers (defaults to the number of CPUs)
+        progress: Optional callback(done, total, stage) called as each task's statistics are merged
+    Returns:
+        stats: StreamingStatistics merged over all tasks, in task order
+    """
+
+    arrays = {"shares": shares, "metric_index": metric_index, "weight_combos": weight_combos}
+    if masks is not None:
+        arrays["masks"] = masks
+
+    batch_size = get_batch_size(batch_size, shares)
+    tasks = [(m, m + 1, start, min(start + batch_size, len(weight_combos)))
+             for m in range(len(metric_index)) for start in range(0, len(weight_combos), batch_size)]
+
+    stats = StreamingStatistics(shares.shape[:-1])
+    done = 0
+    if backend == "threads":
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for partial in executor.map(functools.partial(_sweep_task, arrays=arrays), tasks):
+                stats.merge(partial)
+                done += 1
+                if progress is not None:
+                    progress(done, len(tasks), "combine")
+
+    elif backend == "processes":
+        with tempfile.TemporaryDirectory(prefix="ncqg_sweep_") as directory:
+            paths = {}
+            for key, array in arrays.items():
+                paths[key] = os.path.join(directory, key + ".npy")
+                np.save(paths[key], np.ascontiguousarray(array))
+
+            workers = max_workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers, initializer=_attach_sweep_arrays,
+                                     initargs=(paths,)) as executor:
+                for partial in executor.map(_sweep_task, tasks, chunksize=max(1, len(tasks) // (4 * workers))):
+                    stats.merge(partial)
+                    done += 1
+                    if progress is not None:
+                        progress(done, len(tasks), "combine")
+
+    else:
+        raise ValueError(f"Unknown backend '{backend}'; expected 'serial', 'threads' or 'processes'")
+
+    return stats
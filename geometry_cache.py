@@ -0,0 +1,107 @@
+import os
+import sys
+
+import geopandas as gpd
+import pandas as pd
+
+
+NATURAL_EARTH_URL = "https://naciscdn.org/naturalearth/110m/cultural/ne_110m_admin_0_countries.zip"
+
+# Next to this module, so that every entry point shares one cache whatever its working directory
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "geometry")
+
+# Variant -> (simplification tolerance in degrees, or None to keep the source polygons, CRS)
+VARIANTS = {
+    "full": (None, "EPSG:4326"),
+    "simplified": (0.05, "EPSG:4326"),
+    "robinson": (0.05, "ESRI:54030"),
+}
+
+# Geometries already read in this process, by file
+_LOADED = {}
+
+
+def get_geometry_path(variant, cache_dir=CACHE_DIR):
+
+    return os.path.join(cache_dir, f"ne_110m_admin_0_countries.{variant}.parquet")
+
+
+def build_geometry_cache(source=NATURAL_EARTH_URL, cache_dir=CACHE_DIR):
+    """
+    Read the country polygons once (from the Natural Earth URL or a local copy of the zip) and store
+    every variant as GeoParquet
+    Returns:
+        paths: dictionary of variant -> file
+    """
+
+    world = gpd.read_file(source).to_crs("EPSG:4326")
+
+    # ADM0_A3 rather than ISO_A3, which is -99 for France and Norway in Natural Earth
+    world = world[["ADM0_A3", "NAME", "geometry"]].set_index(pd.Index(world["ADM0_A3"], name="ISO_A3"))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = {}
+    for variant, (tolerance, crs) in VARIANTS.items():
+        variant_world = world.copy()
+        if tolerance is not None:
+            variant_world["geometry"] = variant_world.geometry.simplify(tolerance, preserve_topology=True)
+        variant_world = variant_world.to_crs(crs)
+
+        # Write then rename so that concurrent processes never read a partial file
+        paths[variant] = get_geometry_path(variant, cache_dir)
+        temp_path = paths[variant] + f".{os.getpid()}.tmp"
+        variant_world.to_parquet(temp_path)
+        os.replace(temp_path, paths[variant])
+
+    return paths
+
+
+class GeometryProvider:
+    """
+    Country polygons indexed by ISO_A3 (with an ADM0_A3 column for joins), read from a local
+    GeoParquet or Feather file once per process.
+
+    By default the variants are built in cache_dir from source the first time they are needed,
+    which is the only step that needs the network (or a local copy of the Natural Earth zip).
+    Pointing path at a bundled file skips the cache altogether. Frames are shared between callers,
+    so merge or copy them rather than modifying them in place.
+    """
+
+    def __init__(self, path=None, cache_dir=CACHE_DIR, source=NATURAL_EARTH_URL):
+        """
+        Inputs:
+            path: Optional bundled .parquet or .feather file, used for every variant
+            cache_dir: Directory of the cached variants
+            source: Where build_geometry_cache reads the polygons from
+        """
+
+        self.path = path
+        self.cache_dir = cache_dir
+        self.source = source
+
+    def get(self, variant="simplified"):
+        """
+        Polygons of one variant: "full", "simplified" (EPSG:4326) or "robinson" (simplified, projected)
+        """
+
+        path = self.path or get_geometry_path(variant, self.cache_dir)
+
+        if path not in _LOADED:
+            if not os.path.exists(path):
+                if self.path is not None:
+                    raise FileNotFoundError(f"No geometry file at {path}")
+                build_geometry_cache(self.source, self.cache_dir)
+
+            if path.endswith(".feather"):
+                _LOADED[path] = gpd.read_feather(path)
+            else:
+                _LOADED[path] = gpd.read_parquet(path)
+
+        return _LOADED[path]
+
+
+if __name__ == "__main__":
+
+    # Build the cache ahead of time, e.g. python geometry_cache.py ne_110m_admin_0_countries.zip
+    for variant, path in build_geometry_cache(*sys.argv[1:2]).items():
+        print(f"{variant}: {path}")
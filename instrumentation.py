@@ -0,0 +1,144 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+class Instrumentation:
+    """
+    Progress reporting, per-stage timers and optional profiling for EquityCalculator.
+
+    Stages (load, normalise, combine, aggregate, write) are timed with a wall clock and, when
+    track_memory is set, the peak traced memory allocated inside the stage. A progress callback
+    receives (done, total, stage) as sweeps advance, e.g. to drive a Streamlit progress bar or a
+    logger. With profile=True, a cProfile profiler runs inside every stage and write_report() adds
+    the most expensive functions to the JSON report.
+    """
+
+    def __init__(self, progress_callback=None, track_memory=False, profile=False):
+
+        self.progress_callback = progress_callback
+        self.track_memory = track_memory or profile
+        self.profiler = cProfile.Profile() if profile else None
+        self.records = []
+        self._depth = 0
+        self._peaks = []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as one call of the named stage
+        """
+
+        started_tracing = False
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+
+            # reset_peak() is global, so keep the peak an enclosing stage has reached so far
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+            memory_start = tracemalloc.get_traced_memory()[0]
+        if self.profiler is not None and self._depth == 0:
+            self.profiler.enable()
+
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._depth -= 1
+            if self.profiler is not None and self._depth == 0:
+                self.profiler.disable()
+
+            record = {"stage": name, "seconds": seconds}
+            if self.track_memory:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                record["peak_memory_mb"] = (peak - memory_start) / 1e6
+                if started_tracing:
+                    tracemalloc.stop()
+            self.records.append(record)
+
+    def progress(self, done, total, stage=""):
+        """
+        Report that done out of total units of the named stage have completed
+        """
+
+        if self.progress_callback is not None:
+            self.progress_callback(done, total, stage)
+
+    def summary(self):
+        """
+        Calls, total and mean seconds (and peak memory, if tracked) per stage
+        """
+
+        if not self.records:
+            return pd.DataFrame(columns=["calls", "seconds", "mean_seconds"])
+
+        records = pd.DataFrame(self.records)
+        aggregations = {"calls": ("seconds", "size"), "seconds": ("seconds", "sum"), "mean_seconds": ("seconds", "mean")}
+        if "peak_memory_mb" in records:
+            aggregations["peak_memory_mb"] = ("peak_memory_mb", "max")
+
+        return records.groupby("stage", sort=False).agg(**aggregations)
+
+    def report(self, top=25):
+        """
+        Machine-readable report of every stage call, the per-stage summary and, when profiling,
+        the top functions by cumulative time
+        """
+
+        report = {
+            "stages": self.records,
+            "summary": self.summary().reset_index().to_dict(orient="records"),
+        }
+
+        if self.profiler is not None:
+            stats = pstats.Stats(self.profiler, stream=io.StringIO())
+            functions = []
+            for (filename, line, function), (calls, _, total, cumulative, _) in stats.stats.items():
+                functions.append({"function": function, "file": filename, "line": line, "calls": calls,
+                                  "total_seconds": total, "cumulative_seconds": cumulative})
+            report["profile"] = sorted(functions, key=lambda f: f["cumulative_seconds"], reverse=True)[:top]
+
+        return report
+
+    def write_report(self, path, top=25):
+
+        with open(path, "w") as f:
+            json.dump(self.report(top), f, indent=2)
+
+    def reset(self):
+
+        self.records = []
+        if self.profiler is not None:
+            self.profiler = cProfile.Profile()
+
+
+def logging_progress(logger=None, level=logging.INFO, every=0.1):
+    """
+    Progress callback that logs at most once per `every` fraction of each stage
+    """
+
+    logger = logger or logging.getLogger("equity_calculator")
+    last = {}
+
+    def callback(done, total, stage):
+        fraction = done / total if total else 1.0
+        if fraction >= 1.0 or fraction - last.get(stage, -1.0) >= every:
+            last[stage] = fraction
+            logger.log(level, "%s: %d/%d (%.0f%%)", stage, done, total, fraction * 100)
+
+    return callback
@@ -0,0 +1,127 @@
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import numpy as np
+
+from query_service import PILLARS
+
+
+# Variables per pillar, as listed by EquityCalculator
+VARIABLES = {
+    "Responsibility": ["Cumulative Emissions since 1850", "Cumulative Emissions since 1950",
+                       "Cumulative Emissions per capita"],
+    "Capacity": ["Gross National Income", "Gross National Income minus debt", "Gross National Income per capita"],
+    "Needs": ["Climate Risk and Vulnerability Index", "Physical Climate Risk (EIB)"],
+    "Engagement": ["UN Multilateral Engagement Score"],
+}
+
+
+def make_queries(n_queries, n_distinct=500, seed=0):
+    """
+    Random mix of allocation, contribution and robust queries drawn from n_distinct parameter sets,
+    so that repeated parameters exercise the service's cache
+    Returns:
+        queries: list of request paths with query strings
+    """
+
+    rng = np.random.default_rng(seed)
+    distinct = []
+    for _ in range(n_distinct):
+        kind = rng.choice(["allocations", "contributions", "robust"], p=[0.45, 0.45, 0.1])
+        parameters = {"total_value": int(rng.choice([100, 300, 500])),
+                      "include_UMIC": bool(rng.random() < 0.5), "exclude_US": bool(rng.random() < 0.5)}
+        if kind == "robust":
+            parameters["measure"] = str(rng.choice(["allocations", "contributions"]))
+        else:
+            for pillar in PILLARS:
+                parameters[pillar] = str(rng.choice(VARIABLES[pillar]))
+                parameters[pillar + "_weight"] = int(rng.integers(0, 11))
+            parameters["Responsibility_weight"] += 1
+        distinct.append(f"/{kind}?{urlencode(parameters)}")
+
+    return [distinct[i] for i in rng.integers(0, n_distinct, n_queries)]
+
+
+def run_load_test(url, queries, concurrency=8, timeout=30):
+    """
+    Send every query from concurrency client threads and time each response
+    Returns:
+        report: dictionary of requests, errors, seconds, requests_per_second and latency percentiles in ms
+    """
+
+    local = threading.local()
+    latencies = np.full(len(queries), np.nan)
+    errors = []
+
+    def send(i):
+        opener = getattr(local, "opener", None)
+        if opener is None:
+            opener = local.opener = urllib.request.build_opener()
+        start = time.perf_counter()
+        try:
+            with opener.open(url + queries[i], timeout=timeout) as response:
+                response.read()
+            latencies[i] = time.perf_counter() - start
+        except (urllib.error.URLError, OSError) as error:
+            errors.append(f"{queries[i]}: {error}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(len(queries))))
+    seconds = time.perf_counter() - start
+
+    answered = latencies[~np.isnan(latencies)] * 1000
+    percentiles = np.percentile(answered, [50, 90, 99]) if answered.size else [np.nan] * 3
+
+    return {"requests": len(queries), "errors": len(errors), "seconds": seconds,
+            "requests_per_second": answered.size / seconds, "p50_ms": percentiles[0], "p90_ms": percentiles[1],
+            "p99_ms": percentiles[2], "max_ms": answered.max() if answered.size else np.nan,
+            "first_errors": errors[:5]}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Load test of query_service.py reporting requests per second "
+                                                 "and latency percentiles")
+    parser.add_argument("--url", default=None, help="Base URL of a running service (e.g. http://127.0.0.1:8000); "
+                                                    "by default a service is started in this process")
+    parser.add_argument("--data", default="NCQG Data.xlsx", help="Workbook of the in-process service")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--distinct", type=int, default=500, help="Number of distinct parameter sets")
+    parser.add_argument("--concurrency", type=int, default=8, help="Client threads")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        from query_service import QueryEngine, create_server
+
+        engine = QueryEngine(args.data)
+        server = create_server(engine, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+        print(f"Started the service in {engine.startup_seconds:.1f} s at {url}")
+
+    try:
+        report = run_load_test(url.rstrip("/"), make_queries(args.requests, args.distinct), args.concurrency)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{report['requests']} requests ({report['errors']} errors) in {report['seconds']:.2f} s: "
+              f"{report['requests_per_second']:.0f} requests/s")
+        print(f"Latency p50 {report['p50_ms']:.2f} ms, p90 {report['p90_ms']:.2f} ms, p99 {report['p99_ms']:.2f} ms, "
+              f"max {report['max_ms']:.2f} ms")
+        for error in report["first_errors"]:
+            print("ERROR", error)
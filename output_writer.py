@@ -0,0 +1,192 @@
+import atexit
+import hashlib
+import os
+import queue
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class OutputWriter:
+    """
+    Background writer of robust results as partitioned, compressed Parquet in long format.
+
+    Each scenario (e.g. "allocations" or "contributions_UMIC") is written under three datasets in
+    directory, partitioned by scenario:
+        shares/scenario=<name>/part-0.parquet          run_id, <key>, share: one row per run and unit
+        robust/scenario=<name>/part-0.parquet          <key>, ISO, Country, Region, share (and share_se)
+        run_parameters/scenario=<name>/part-0.parquet  run_id and the metric and weight of each pillar
+    run_id and the key column (ISO, or the unit column for sub-national data) are dictionary-encoded,
+    so reading a dataset back with pyarrow or pandas gives categorical columns plus the scenario column.
+
+    write_scenario() only queues the data; a single worker thread hashes it and writes files whose
+    content hash differs from the one stored in the existing file's metadata. The queue is bounded,
+    so a caller producing results faster than they can be written blocks instead of piling them up.
+    """
+
+    def __init__(self, directory="outputs", max_pending=4, compression="zstd", background=True):
+        """
+        Inputs:
+            directory: Root directory of the datasets
+            max_pending: Maximum number of queued writes before write_scenario blocks
+            compression: Parquet compression codec
+            background: If False, write synchronously on the calling thread
+        """
+
+        self.directory = directory
+        self.compression = compression
+        self.background = background
+        self.written = []
+        self.skipped = []
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get_path(self, dataset, scenario):
+
+        return os.path.join(self.directory, dataset, f"scenario={scenario}", "part-0.parquet")
+
+    def write_scenario(self, scenario, data, runs=None, summary_df=None, key_column="ISO", value_col=None):
+        """
+        Queue one scenario for writing
+        Inputs:
+            scenario: Partition name
+            data: pandas dataframe with key_column, Country, Region and the robust share in value_col
+            runs: Optional numpy array (runs x rows of data), as returned by calculate_run_shares
+            summary_df: Optional parameters of each run, indexed RUN1..RUNn
+            key_column: Column identifying each row of data
+            value_col: Robust share column (defaults to Robust_Share or Robust_Contribution)
+        """
+
+        if value_col is None:
+            value_col = "Robust_Share" if "Robust_Share" in data else "Robust_Contribution"
+
+        task = (scenario, data, None if runs is None else np.asarray(runs), summary_df, key_column, value_col)
+        if not self.background:
+            self._write(*task)
+            return
+
+        self._start()
+        self._queue.put(task)
+
+    def flush(self):
+        """
+        Wait until every queued write has finished, re-raising the first error of the worker
+        """
+
+        if self._thread is not None:
+            self._queue.join()
+        if self._errors:
+            error, self._errors = self._errors[0], []
+            raise error
+
+    def close(self):
+
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _start(self):
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="OutputWriter", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _worker(self):
+
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                self._write(*task)
+            except Exception as error:
+                self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, scenario, data, runs, summary_df, key_column, value_col):
+
+        keys = data[key_column].to_numpy(dtype=str)
+        key_dictionary = pa.array(keys)
+
+        robust = {key_column: pa.DictionaryArray.from_arrays(pa.array(np.arange(len(keys), dtype=np.int32)),
+                                                              key_dictionary)}
+        for column in ["ISO", "Country", "Region"]:
+            if column != key_column:
+                robust[column] = data[column].to_numpy(dtype=str)
+        robust["share"] = data[value_col].to_numpy()
+        if value_col + "_SE" in data:
+            robust["share_se"] = data[value_col + "_SE"].to_numpy()
+        self._write_table(pa.table(robust), self.get_path("robust", scenario))
+
+        if runs is not None:
+            run_ids = pa.array([f"RUN{i}" for i in range(1, runs.shape[0] + 1)])
+            n_runs, n_keys = runs.shape
+            shares = pa.table({
+                "run_id": pa.DictionaryArray.from_arrays(
+                    pa.array(np.repeat(np.arange(n_runs, dtype=np.int32), n_keys)), run_ids),
+                key_column: pa.DictionaryArray.from_arrays(
+                    pa.array(np.tile(np.arange(n_keys, dtype=np.int32), n_runs)), key_dictionary),
+                "share": np.ascontiguousarray(runs).ravel(),
+            })
+            self._write_table(shares, self.get_path("shares", scenario))
+
+        if summary_df is not None:
+            parameters = summary_df.rename_axis("run_id").reset_index()
+            self._write_table(pa.Table.from_pandas(parameters, preserve_index=False),
+                              self.get_path("run_parameters", scenario))
+
+    def _write_table(self, table, path):
+
+        digest = hashlib.blake2b(digest_size=16)
+        for column in table.columns:
+            for chunk in column.chunks:
+                for buffer in chunk.buffers():
+                    if buffer is not None:
+                        digest.update(buffer)
+            if pa.types.is_dictionary(column.type):
+                for chunk in column.chunks:
+                    for buffer in chunk.dictionary.buffers():
+                        if buffer is not None:
+                            digest.update(buffer)
+        digest.update(str(table.schema.names).encode())
+        content_hash = digest.hexdigest()
+
+        # Skip files that already hold this content
+        if os.path.exists(path):
+            metadata = pq.read_schema(path).metadata or {}
+            if metadata.get(b"content_hash") == content_hash.encode():
+                self.skipped.append(path)
+                return
+
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"content_hash": content_hash.encode()})
+
+        # Write then rename so that readers never see a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        pq.write_table(table, temp_path, compression=self.compression, use_dictionary=True)
+        os.replace(temp_path, path)
+        self.written.append(path)
+
+
+def read_dataset(directory, dataset="shares", scenarios=None):
+    """
+    Read one dataset written by OutputWriter into a pandas dataframe with a scenario column
+    Inputs:
+        directory: Root directory of the datasets
+        dataset: "shares", "robust" or "run_parameters"
+        scenarios: Optional list of scenarios to read; other partitions are not opened
+    """
+
+    filters = None if scenarios is None else [("scenario", "in", list(scenarios))]
+
+    return pq.read_table(os.path.join(directory, dataset), filters=filters, partitioning="hive").to_pandas()
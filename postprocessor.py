@@ -1,54 +1,217 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 from matplotlib.cm import get_cmap
 from matplotlib.colors import Normalize
-import geopandas as gpd
 import plotly.graph_objects as go
+from geometry_cache import GeometryProvider
+
+def select_rank_one_flows(contrib_vals, share_vals, min_value=None, top_k=None, top_k_by="source"):
+    """
+    Positions of the flows v_ij = c_i * s_j to keep, without building the (sources x targets) matrix
+    Inputs:
+        contrib_vals: numpy array of source contributions c_i (non-negative)
+        share_vals: numpy array of target shares s_j (non-negative)
+        min_value: Keep flows with v_ij >= min_value
+        top_k: Keep the k largest flows of every source (top_k_by="source") or of every target ("target")
+    Returns:
+        source_idx, target_idx: numpy arrays of positions, source by source, with each source's
+            targets in their original order
+    """
+
+    # Targets sorted by share: each source keeps a prefix of them
+    target_order = np.argsort(-share_vals, kind="stable")
+    sources = np.arange(len(contrib_vals))
+    if top_k is not None and top_k_by == "target":
+        # Every target's largest flows come from the same k largest contributors
+        sources = np.sort(np.argsort(-contrib_vals, kind="stable")[:top_k])
+    elif top_k is not None and top_k_by != "source":
+        raise ValueError(f"Unknown top_k_by '{top_k_by}'; expected 'source' or 'target'")
+
+    counts = np.full(len(sources), len(share_vals))
+    if top_k is not None and top_k_by == "source":
+        counts = np.minimum(counts, top_k)
+    if min_value is not None:
+        # s_j >= min_value / c_i, slightly relaxed here and applied exactly below
+        with np.errstate(divide="ignore"):
+            thresholds = float(min_value) / contrib_vals[sources] * (1 - 1e-9)
+        ascending = share_vals[target_order][::-1]
+        counts = np.minimum(counts, len(share_vals) - np.searchsorted(ascending, thresholds, side="left"))
+
+    source_idx = np.repeat(sources, counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    target_idx = target_order[offsets]
+
+    if min_value is not None:
+        keep = contrib_vals[source_idx] * share_vals[target_idx] >= float(min_value)
+        source_idx, target_idx = source_idx[keep], target_idx[keep]
+
+    order = np.lexsort((target_idx, source_idx))
+
+    return source_idx[order], target_idx[order]
+
+
+def _figure_path(savepath):
+
+    # matplotlib adds its default format when the path has no extension
+    return savepath if os.path.splitext(savepath)[1] else savepath + ".png"
+
+
+# Data of each render worker, set up once by _init_render_worker
+_RENDER_DATA = None
+
+
+def _init_render_worker(contributions, allocations, regions, geometry):
+
+    global _RENDER_DATA
+    plt.switch_backend("Agg")
+
+    data = Data(regions=regions, geometry=geometry)
+    data._contributions = contributions
+    data._scenarios["allocations"] = allocations
+    data.geometry.get()
+    _RENDER_DATA = data
+
+
+def _render_job(job):
+
+    return _RENDER_DATA.render_job(job)
+
+
+# Scenario attribute -> (results store family, legacy CSV, share column)
+SCENARIOS = {
+    "contributions_all": ("contributions_UMIC", "Robust_Contributions_NCQG_UMIC.csv", "Robust_Contribution"),
+    "contributions_all_usa": ("contributions_UMIC_US", "Robust_Contributions_NCQG_UMIC_US.csv", "Robust_Contribution"),
+    "contributions_hic": ("contributions", "Robust_Contributions_NCQG.csv", "Robust_Contribution"),
+    "contributions_hic_usa": ("contributions_US", "Robust_Contributions_NCQG_US.csv", "Robust_Contribution"),
+    "allocations": ("allocations", "Robust_Allocations_NCQG.csv", "Robust_Share"),
+}
+
 
 class Data:
-    def __init__(self):
+    def __init__(self, store=None, results=None, equity_calculator=None, regions=None, geometry=None):
+        """
+        Every scenario is loaded on first access, from the first source given:
+        Inputs:
+            results: Optional dictionary of family ("allocations", "contributions{extension}") -> dataframe, or a
+                function returning one, e.g. the frames returned by the EquityCalculator robust methods
+            store: Optional results_store.ResultsStore to read the robust results from
+            equity_calculator: Optional EquityCalculator; the robust results are computed in memory without writing
+                any CSV, all four donor pools in one streaming sweep
+            Otherwise the robust CSVs in the working directory are read.
+            regions: Optional dataframe with ISO and Region (defaults to DATA/country_mapping.csv)
+            geometry: Optional geometry_cache.GeometryProvider for the maps (defaults to the local cache)
+        """
 
         # Convert shares to totals
         self.ncqg = 300
-        
-        # Get contributions
-        self.contributions_all = pd.read_csv("Robust_Contributions_NCQG_UMIC.csv")
-        self.contributions_all_usa = pd.read_csv("Robust_Contributions_NCQG_UMIC_US.csv")
-        self.contributions_hic = pd.read_csv("Robust_Contributions_NCQG.csv")
-        self.contributions_hic_usa = pd.read_csv("Robust_Contributions_NCQG_US.csv")
-        self.contributions = self.collate_contributions()
-
-        
-        # Get allocations
-        self.allocations = pd.read_csv("Robust_Allocations_NCQG.csv")
-        self.allocations["Robust_Share"] = self.allocations["Robust_Share"] * self.ncqg
 
-        # Get regions
-        self.regions = pd.read_csv("./DATA/country_mapping.csv")
-       
+        self.store = store
+        self.results = results or {}
+        self.equity_calculator = equity_calculator
+        self._scenarios = {}
+        self._contributions = None
+        self._regions = regions
+        self.geometry = geometry if geometry is not None else GeometryProvider()
 
-        
+    def load_family(self, family, filename, value_col):
+        """
+        Robust results of one family as a dataframe with Country, ISO, Region and value_col
+        """
 
+        if family in self.results:
+            data = self.results[family]
+            return data() if callable(data) else data
+
+        if self.store is not None:
+            return self.store.open(family).to_frame(value_col)
+
+        if self.equity_calculator is not None:
+            if family == "allocations":
+                # Swept directly rather than through calculate_robust_allocation, which writes its CSV
+                equity_calculator = self.equity_calculator
+                data = equity_calculator.data.loc[equity_calculator.data["AnnexII_countries"] == 0].copy()
+                _, metric_index = equity_calculator.get_metric_combinations()
+                stats = equity_calculator.accumulate_run_statistics(equity_calculator.normalise_indicators(data),
+                                                                    metric_index)
+                data["Robust_Share"] = stats.mean / np.nansum(stats.mean)
+                return data
+
+            # One sweep over every donor pool, kept for the other contribution families
+            pools = self.equity_calculator.get_donor_pools()
+            frames, stats = self.equity_calculator.calculate_robust_contributions_pools(list(pools.values()),
+                                                                                        streaming=True)
+            self.results.update({"contributions" + extension: frame for extension, frame in zip(pools, frames)})
+            return self.results[family]
+
+        return pd.read_csv(filename)
+
+    def get_scenario(self, name):
+
+        if name not in self._scenarios:
+            family, filename, value_col = SCENARIOS[name]
+            data = self.load_family(family, filename, value_col)
+            if name == "allocations":
+                data = data.copy()
+                data["Robust_Share"] = data["Robust_Share"] * self.ncqg
+            self._scenarios[name] = data
+
+        return self._scenarios[name]
+
+    @property
+    def contributions_all(self):
+        return self.get_scenario("contributions_all")
+
+    @property
+    def contributions_all_usa(self):
+        return self.get_scenario("contributions_all_usa")
+
+    @property
+    def contributions_hic(self):
+        return self.get_scenario("contributions_hic")
+
+    @property
+    def contributions_hic_usa(self):
+        return self.get_scenario("contributions_hic_usa")
+
+    @property
+    def allocations(self):
+        return self.get_scenario("allocations")
+
+    @property
+    def contributions(self):
+        if self._contributions is None:
+            self._contributions = self.collate_contributions()
+        return self._contributions
+
+    @property
+    def regions(self):
+        if self._regions is None:
+            self._regions = pd.read_csv("./DATA/country_mapping.csv")
+        return self._regions
 
     def collate_contributions(self):
-        
-        robust_all = self.contributions_all[["Country", "ISO", "Region", "Robust_Contribution"]]
-        robust_all_usa = self.contributions_all_usa[["Country", "ISO", "Region", "Robust_Contribution"]]
-        robust_hic = self.contributions_hic[["Country", "ISO", "Region", "Robust_Contribution"]]
-        robust_hic_us = self.contributions_hic_usa[["Country", "ISO", "Region", "Robust_Contribution"]]
-
-        # For all dataframes
-        for data in [robust_all, robust_all_usa, robust_hic,robust_hic_us]:
-            data["Robust_Contribution"] = data["Robust_Contribution"] * self.ncqg
-
-        collated_robust = robust_all_usa.merge(robust_hic.rename(columns={"Robust_Contribution":"HIC_No_US"}),how="left", 
-                                           on=["Country", "ISO", "Region"]).merge(robust_hic_us.rename(columns={"Robust_Contribution":"HIC"}),how="left", 
-                                           on=["Country", "ISO", "Region"]).merge(robust_all.rename(columns={"Robust_Contribution":"UMIC_No_US"}),how="left", 
-                                           on=["Country", "ISO", "Region"])
-        
-        return collated_robust
+        """
+        All four donor pools side by side, aligned on ISO to the widest pool (UMIC/HIC including the USA)
+        """
+
+        collated = self.contributions_all_usa[["Country", "ISO", "Region"]].set_index("ISO", drop=False)
+        pools = {
+            "Robust_Contribution": self.contributions_all_usa,
+            "HIC_No_US": self.contributions_hic,
+            "HIC": self.contributions_hic_usa,
+            "UMIC_No_US": self.contributions_all,
+        }
+        values = pd.concat({name: data.set_index("ISO")["Robust_Contribution"] for name, data in pools.items()}, axis=1)
+
+        collated = collated.join(values.reindex(collated.index) * self.ncqg)
+
+        return collated.reset_index(drop=True)
 
     def produce_contributions_figure(self):
 
@@ -71,6 +234,92 @@ class Data:
         self.plot_map_and_top20_allocations(allocations, value_col="Robust_Share", cmap="YlOrRd", 
                                 savepath="Distributions", label="")
 
+    def get_default_render_jobs(self):
+        """
+        The figures of produce_contributions_figure plus the Sankey of Annex II contributions, as render jobs
+        """
+
+        cmap = "YlGnBu"
+        return [
+            ("contributions", "HIC", "Contributions_HIC", {"cmap": cmap, "label": "All Annex II countries"}),
+            ("contributions", "HIC_No_US", "Contributions_HIC_NO_USA",
+             {"cmap": cmap, "label": "All Annex II countries (exc. USA)"}),
+            ("contributions", "Robust_Contribution", "Contributions_UMIC", {"cmap": cmap, "label": "All UMIC countries"}),
+            ("contributions", "UMIC_No_US", "Contributions_UMIC_NO_USA",
+             {"cmap": cmap, "label": "All UMIC countries (exc. USA)"}),
+            ("allocations", "Robust_Share", "Distributions", {"cmap": "YlOrRd", "label": ""}),
+            ("sankey", "HIC", "sankey.html", {"threshold_billion": 5}),
+        ]
+
+    def render_figures(self, jobs=None, max_workers=None, manifest_path=None):
+        """
+        Render a batch of figures on a pool of worker processes. Every worker receives the collated
+        contributions, allocations and regions once, loads the map polygons once and then renders its
+        share of the jobs.
+        Inputs:
+            jobs: List of (scenario, value_col, savepath) or (scenario, value_col, savepath, options), where scenario is
+                "contributions" (plot_map_and_top20 of the collated donor pools), "allocations"
+                (plot_map_and_top20_allocations) or "sankey" (flows from value_col to the allocations, grouped
+                by region and written as HTML), and options holds cmap, label or threshold_billion.
+                Defaults to get_default_render_jobs()
+            max_workers: Number of worker processes (defaults to the number of CPUs); 0 renders in this process
+            manifest_path: Optional JSON file to write the manifest to
+        Returns:
+            manifest: List with, per job, its scenario, value_col, output files, seconds, worker process and error
+        """
+
+        jobs = self.get_default_render_jobs() if jobs is None else jobs
+
+        if max_workers == 0:
+            manifest = [self.render_job(job) for job in jobs]
+        else:
+            state = (self.contributions, self.allocations, self.regions, self.geometry)
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_render_worker,
+                                     initargs=state) as executor:
+                manifest = list(executor.map(_render_job, jobs))
+
+        if manifest_path is not None:
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+
+        return manifest
+
+    def render_job(self, job):
+        """
+        Render one job of render_figures and describe its outputs
+        """
+
+        scenario, value_col, savepath = job[:3]
+        options = job[3] if len(job) > 3 else {}
+        entry = {"scenario": scenario, "value_col": value_col, "savepath": savepath, "outputs": [],
+                 "seconds": None, "worker": os.getpid(), "error": None}
+
+        start = time.perf_counter()
+        try:
+            if scenario == "contributions":
+                self.plot_map_and_top20(self.contributions, value_col=value_col, cmap=options.get("cmap", "YlGnBu"),
+                                        savepath=savepath, label=options.get("label", ""))
+                entry["outputs"] = [_figure_path(savepath)]
+            elif scenario == "allocations":
+                self.plot_map_and_top20_allocations(self.allocations, value_col=value_col,
+                                                    cmap=options.get("cmap", "YlOrRd"), savepath=savepath,
+                                                    label=options.get("label", ""))
+                entry["outputs"] = [_figure_path(savepath), _figure_path(savepath + "_bar")]
+            elif scenario == "sankey":
+                flows = self.make_sankey_flows_net(contrib_col=value_col, dist_col="Robust_Share")
+                grouped_flows = self.build_sankey_grouped_by_region(
+                    flows, threshold_billion=options.get("threshold_billion", 5))
+                self.plot_sankey_from_grouped(grouped_flows=grouped_flows, savepath=savepath)
+                entry["outputs"] = [savepath]
+            else:
+                raise ValueError(f"Unknown scenario '{scenario}'; expected 'contributions', 'allocations' or 'sankey'")
+        except Exception as error:
+            entry["error"] = f"{type(error).__name__}: {error}"
+            plt.close("all")
+        entry["seconds"] = time.perf_counter() - start
+
+        return entry
+
 
 
             
@@ -94,9 +343,8 @@ class Data:
             savepath: file path to save the figure
             dpi: output resolution
         """
-        # Load Natural Earth lowres polygons and join by ISO3
-        url = "https://naciscdn.org/naturalearth/110m/cultural/ne_110m_admin_0_countries.zip"
-        world = gpd.read_file(url)
+        # Natural Earth lowres polygons from the local cache, joined by ISO3
+        world = self.geometry.get()
 
 
         plot_df = world.merge(
@@ -228,9 +476,8 @@ class Data:
             savepath: file path to save the figure
             dpi: output resolution
         """
-        # Load Natural Earth lowres polygons and join by ISO3
-        url = "https://naciscdn.org/naturalearth/110m/cultural/ne_110m_admin_0_countries.zip"
-        world = gpd.read_file(url)
+        # Natural Earth lowres polygons from the local cache, joined by ISO3
+        world = self.geometry.get()
 
 
         plot_df = world.merge(
@@ -323,7 +570,9 @@ class Data:
         allow_negative_inputs: bool = False,  # allow negative inputs (both c and d)
         min_value: float = None,    # drop flows smaller than this
         round_to: float = None,       # round flow values to N decimals
-        sort_desc: bool = True                # sort by value descending
+        sort_desc: bool = True,               # sort by value descending
+        top_k: int = None,                    # keep only the k largest flows per source (or target)
+        top_k_by: str = "source"              # "source" or "target"
     ) -> pd.DataFrame:
         """
         Build a Sankey-ready DataFrame with columns [source, target, value].
@@ -335,6 +584,11 @@ class Data:
         Flows:
             v_ij = c_i * Share_j
 
+        The flow matrix is rank one, so every source ranks the targets in the same order (by share) and
+        every target ranks the sources in the same order (by contribution). Flows above min_value and
+        the top_k per source or target are therefore found from the two sorted vectors, and only the
+        kept flows are ever built.
+
         Parameters
         ----------
         contributions : DataFrame with [source_col, contrib_col]
@@ -347,14 +601,16 @@ class Data:
         min_value     : Optional threshold to filter small flows
         round_to      : Optional decimals to round flow values
         sort_desc     : Sort flows by value descending
+        top_k         : Optional number of flows to keep per source (top_k_by="source") or target ("target")
 
         Returns
         -------
-        DataFrame with columns [source, target, value]
+        DataFrame with columns [source, target, value, Target_ISO, Target_Region, Source_ISO, Source_Region],
+        with the total and kept flow in flows.attrs["total_value"] and flows.attrs["kept_value"]
         """
         # Select relevant columns and drop NaNs
-        c = self.contributions[[source_col, contrib_col]].dropna()
-        d = self.allocations[[target_col, dist_col]].dropna()
+        c = self.contributions[[source_col, contrib_col, "ISO"]].dropna(subset=[source_col, contrib_col])
+        d = self.allocations[[target_col, dist_col, "ISO"]].dropna(subset=[target_col, dist_col])
 
         # Ensure there are no negatives in distributions (already clipped)
         # Drop zero-net targets to reduce noise (optional but harmless)
@@ -366,53 +622,46 @@ class Data:
             raise ValueError("Sum of net distributions is 0 after subtraction; cannot compute shares.")
 
         # Compute shares
-        d["Share"] = d[dist_col] / net_total
+        share_vals = (d[dist_col] / net_total).to_numpy()
 
         # Correct for if the quantum does not file
-        d[dist_col] = d[dist_col] * net_total / d[dist_col].sum()
-        c[contrib_col] = c[contrib_col] * net_total / c[contrib_col].sum()
+        contrib_vals = (c[contrib_col] * net_total / c[contrib_col].sum()).to_numpy()
 
-        # Prepare vectors
-        sources = c[source_col].to_numpy()
-        targets = d[target_col].to_numpy()
-        contrib_vals = c[contrib_col].to_numpy()
-        share_vals = d["Share"].to_numpy()
-
-        # Outer product to compute all flows
-        flows_matrix = np.outer(contrib_vals, share_vals)  # shape: (n_sources, n_targets)
-
-        # Long form DataFrame
-        flows = (
-            pd.DataFrame(flows_matrix, index=sources, columns=targets).stack().reset_index()
-        )
-        flows.columns = ["source", "target", "value"]
+        # Sanity check on the full mass, before any filtering: the flows sum to the total contributions
+        # because the shares sum to 1
+        total_contrib = contrib_vals.sum()
+        if not np.isclose(total_contrib * share_vals.sum(), total_contrib):
+            raise RuntimeError("Flow totals do not match total contributions. Check inputs.")
 
-        # Optional filtering/rounding/sorting
-        if min_value is not None:
-            flows = flows[flows["value"] >= float(min_value)]
+        # Kept flows only, as (source, target) positions
+        source_idx, target_idx = select_rank_one_flows(contrib_vals, share_vals, min_value, top_k, top_k_by)
+        values = contrib_vals[source_idx] * share_vals[target_idx]
 
         if round_to is not None:
-            flows["value"] = flows["value"].round(int(round_to))
+            values = np.round(values, int(round_to))
 
         if sort_desc:
-            flows = flows.sort_values("value", ascending=False).reset_index(drop=True)
-
-        # Sanity check: sum of flows equals total contributions (shares sum to 1)
-        total_contrib = c[contrib_col].sum()
-        if not np.isclose(flows["value"].sum(), total_contrib):
-            raise RuntimeError("Flow totals do not match total contributions. Check inputs.")
-        
-        # Merge on ISOs
-        iso = self.contributions[[target_col, "ISO"]]
-        flows = pd.merge(flows, iso, how="left", left_on="target", right_on=target_col)
-        flows = pd.merge(flows, self.regions[["ISO", "Region"]], how="left", on="ISO")
-        flows = flows.rename(columns={"ISO":"Target_ISO"})
-
-        # Do the same for sources
-        flows = pd.merge(flows, iso, how="left", left_on="source", right_on=source_col)
-        flows = pd.merge(flows, self.regions[["ISO", "Region"]], how="left", on="ISO")
-        flows = flows.rename(columns={"ISO":"Source_ISO"})
-
+            order = np.argsort(-values, kind="stable")
+            source_idx, target_idx, values = source_idx[order], target_idx[order], values[order]
+
+        # Attach ISO codes and regions by position
+        region_of = self.regions.drop_duplicates("ISO").set_index("ISO")["Region"]
+        source_iso = c["ISO"].to_numpy()
+        target_iso = d["ISO"].to_numpy()
+        source_region = region_of.reindex(source_iso).to_numpy()
+        target_region = region_of.reindex(target_iso).to_numpy()
+
+        flows = pd.DataFrame({
+            "source": c[source_col].to_numpy()[source_idx],
+            "target": d[target_col].to_numpy()[target_idx],
+            "value": values,
+            "Target_ISO": target_iso[target_idx],
+            "Target_Region": target_region[target_idx],
+            "Source_ISO": source_iso[source_idx],
+            "Source_Region": source_region[source_idx],
+        })
+        flows.attrs["total_value"] = float(total_contrib)
+        flows.attrs["kept_value"] = float(values.sum())
 
         return flows
     
@@ -442,60 +691,77 @@ class Data:
 
         """
 
-        # Validate inputs
-        for col in (source_col, target_col, value_col):
-            if col not in flows.columns:
-                raise ValueError(f"flows missing required column '{col}'.")
-
-        df = flows[[source_col, target_col, value_col, "Target_ISO", "Source_ISO"]].copy()
-        #df.dropna(subset=[source_col, target_col, value_col, "Target_ISO", "Source_ISO"], inplace=True)
-
-        # Compute inflow/outflow per country FALLS TO 163 BN HERE
-        inflow = df.groupby(target_col, as_index=True)[value_col].sum()
-        outflow = df.groupby(source_col, as_index=True)[value_col].sum()
-
-        # Union of all nodes appearing as source/target
-        nodes = pd.Index(sorted(set(df[source_col]).union(set(df[target_col]))))
-
-        # Align inflow/outflow to all nodes, fill missing with 0
-        inflow = inflow.reindex(nodes, fill_value=0.0)
-        outflow = outflow.reindex(nodes, fill_value=0.0)
-
-        # Major/minor classification
-        is_major = (np.maximum(inflow.values, outflow.values) > threshold_billion)
-        node_status = pd.DataFrame({
-            "node": nodes,
-            "inflow": inflow.values,
-            "outflow": outflow.values,
-            "is_major": is_major
-        })
-
-        # Build country->region map
-        regions = self.regions
-        region_map = regions.set_index("ISO")[region_col].to_dict()
-
-        # Map function: country -> aggregated label
-        def map_node(country: str) -> str:
-            if country in node_status[node_status["is_major"]]["node"].values:
-                return country  # keep major node as-is
-            region = region_map.get(country, None)
-            return f"{region}{group_suffix}"
+        return self.build_sankey_grouped_by_region_sweep(
+            flows, [threshold_billion], source_col=source_col, target_col=target_col, value_col=value_col,
+            region_col=region_col, group_suffix=group_suffix, drop_self_loops=drop_self_loops)[threshold_billion]
 
-        # Apply mapping to sources and targets
-        df["source_grouped"] = df["source"]
-        df["target_grouped"] = df["Target_ISO"].map(map_node)
+    def build_sankey_grouped_by_region_sweep(self,
+        flows: pd.DataFrame,
+        thresholds: list[float],
+        *,
+        source_col: str = "source",
+        target_col: str = "target",
+        value_col: str = "value",
+        region_col: str = "Region",
+        group_suffix: str = " (grouped)",
+        drop_self_loops: bool = True,
+    ) -> dict[float, pd.DataFrame]:
+        """
+        Grouped flows (as build_sankey_grouped_by_region) for several thresholds in one pass, e.g. to draw
+        the same Sankey at several levels of detail.
 
-        # Optionally drop self-loops after grouping
-        if drop_self_loops:
-            df = df[df["source_grouped"] != df["target_grouped"]].copy()
+        Node totals and region labels are computed once and the nodes are sorted by their largest flow
+        once, so each threshold only cuts the sorted nodes and aggregates the relabelled flows.
 
-        # Aggregate flows after grouping
-        grouped_flows = (
-            df.groupby(["source_grouped", "target_grouped"], as_index=False)[value_col].sum().rename(columns={"source_grouped": "source", "target_grouped": "target"})
-        )
+        Returns
+        -------
+        Dictionary of threshold -> DataFrame with [source, target, value_col]
+        """
 
+        # Validate inputs
+        for col in (source_col, target_col, value_col, "Target_ISO"):
+            if col not in flows.columns:
+                raise ValueError(f"flows missing required column '{col}'.")
 
-        return grouped_flows
+        sources = flows[source_col].to_numpy()
+        targets = flows[target_col].to_numpy()
+        values = flows[value_col].to_numpy(dtype=float)
+
+        # Inflow/outflow of every node appearing as source/target
+        nodes, codes = np.unique(np.concatenate([sources, targets]), return_inverse=True)
+        source_codes, target_codes = codes[:len(flows)], codes[len(flows):]
+        inflow = np.bincount(target_codes, weights=values, minlength=len(nodes))
+        outflow = np.bincount(source_codes, weights=values, minlength=len(nodes))
+        node_max = np.maximum(inflow, outflow)
+
+        # Region label of every flow's target, looked up once by ISO
+        region_of = self.regions.drop_duplicates("ISO").set_index("ISO")[region_col]
+        grouped_targets = (region_of.reindex(flows["Target_ISO"]).fillna("None").astype(str) + group_suffix).to_numpy()
+
+        # Nodes by largest flow: the major nodes of each threshold are a suffix of this order
+        order = np.argsort(node_max, kind="stable")
+        sorted_max = node_max[order]
+
+        grouped = {}
+        for threshold in thresholds:
+            is_major = np.zeros(len(nodes), dtype=bool)
+            is_major[order[np.searchsorted(sorted_max, threshold, side="right"):]] = True
+
+            # Major targets keep their own node, minor ones collapse into their region
+            df = pd.DataFrame({
+                "source": sources,
+                "target": np.where(is_major[target_codes], targets, grouped_targets),
+                value_col: values,
+            })
+
+            # Optionally drop self-loops after grouping
+            if drop_self_loops:
+                df = df[df["source"] != df["target"]]
+
+            # Aggregate flows after grouping
+            grouped[threshold] = df.groupby(["source", "target"], as_index=False)[value_col].sum()
+
+        return grouped
     
 
 
@@ -509,7 +775,8 @@ class Data:
         palette: list[str] | None = None,  # optional region color palette
         node_colors_by_label: dict[str, str] | None = None,  # optional explicit node label -> color
         node_pad: int = 12,
-        node_thickness: int = 18
+        node_thickness: int = 18,
+        savepath: str = "sankey.html"
     ):
         """
         Plot a Sankey diagram from pre-grouped flows.
@@ -521,6 +788,7 @@ class Data:
                         If node labels end with group_suffix (e.g., 'Europe (grouped)'), their region is inferred
                         directly from the label. Otherwise, region is looked up via `regions`.
         node_colors_by_label : Optional explicit mapping: node label -> color. Overrides region palette for those labels.
+        savepath      : HTML file to write
 
         Returns
         -------
@@ -583,23 +851,25 @@ class Data:
         )])
 
         # Saves a fully interactive file you can open in any browser
-        fig.write_html("sankey.html", include_plotlyjs="cdn", full_html=True)
+        fig.write_html(savepath, include_plotlyjs="cdn", full_html=True)
 
         return fig
 
 
 
-data = Data()
-#data.produce_contributions_figure()
-flows = data.make_sankey_flows_net(source_col="Country",
-                       contrib_col = "HIC",
-                       target_col= "Country",
-                       dist_col="Robust_Share",
-                       allow_negative_inputs=False)
-grouped_flows = data.build_sankey_grouped_by_region(
-    flows=flows,
-    threshold_billion=5,    
-)
-data.plot_sankey_from_grouped(grouped_flows=grouped_flows)
-test = data
-                                    
\ No newline at end of file
+if __name__ == "__main__":
+
+    data = Data()
+    #data.produce_contributions_figure()
+    flows = data.make_sankey_flows_net(source_col="Country",
+                           contrib_col = "HIC",
+                           target_col= "Country",
+                           dist_col="Robust_Share",
+                           allow_negative_inputs=False)
+    grouped_flows = data.build_sankey_grouped_by_region(
+        flows=flows,
+        threshold_billion=5,    
+    )
+    data.plot_sankey_from_grouped(grouped_flows=grouped_flows)
+    test = data
+
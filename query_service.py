@@ -0,0 +1,310 @@
+import argparse
+import functools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+from equity_calculator import EquityCalculator
+from output_writer import OutputWriter
+
+
+PILLARS = ["Responsibility", "Capacity", "Needs", "Engagement"]
+
+# Defaults of the Streamlit app for parameters a query leaves out
+DEFAULTS = {"total_value": 300.0, "include_UMIC": True, "exclude_US": True}
+
+# Donor pools as (include_UMIC, exclude_US)
+DONOR_POOLS = [(False, True), (False, False), (True, True), (True, False)]
+
+
+def _parse_bool(value):
+
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ("true", "1", "yes", "y"):
+        return True
+    if str(value).strip().lower() in ("false", "0", "no", "n"):
+        return False
+    raise ValueError(f"Expected a boolean, got '{value}'")
+
+
+class QueryEngine:
+    """
+    Pre-warmed allocation, contribution and robust-summary queries over one loaded dataset.
+
+    The workbook is loaded once, the share matrices of the recipients and of every donor pool are
+    normalised once, and the robust statistics of every scenario family are swept once at start-up,
+    so a query only weights four share columns. Answers are serialised to JSON once and kept in an
+    LRU cache keyed on the normalised parameters (canonical pillar order, floats, defaults filled in
+    and, for allocations, without the donor pool). The engine is read-only after start-up and safe
+    to share between request threads.
+    """
+
+    def __init__(self, data="NCQG Data.xlsx", fast_load=True, cache_size=4096, output_dir=None):
+        """
+        Inputs:
+            data: Path to the NCQG workbook, or a "Summary"-shaped pandas dataframe
+            fast_load: Load the workbook through its columnar cache
+            cache_size: Maximum number of cached answers
+            output_dir: Optional directory to write the start-up robust results to as Parquet (see OutputWriter);
+                by default nothing is written
+        """
+
+        start = time.perf_counter()
+        writer = OutputWriter(output_dir) if output_dir is not None else None
+        self.equity_calculator = EquityCalculator(data, fast_load=fast_load, writer=writer)
+        self.variables = {pillar: list(variables) for pillar, variables in zip(PILLARS, [
+            self.equity_calculator.responsibility_dict, self.equity_calculator.capacity_dict,
+            self.equity_calculator.needs_dict, self.equity_calculator.engagement_dict])}
+
+        data = self.equity_calculator.data
+        recipients = data["AnnexII_countries"].to_numpy() == 0
+        self.allocation_rows = self.get_rows(recipients)
+        self.allocation_shares = self.equity_calculator.normalise_indicators(data.loc[recipients])
+
+        self.contribution_rows = {}
+        self.contribution_shares = {}
+        for pool in DONOR_POOLS:
+            mask = self.equity_calculator.get_donor_pool(*pool)
+            self.contribution_rows[pool] = self.get_rows(mask)
+            self.contribution_shares[pool] = self.equity_calculator.normalise_indicators(data.loc[mask],
+                                                                                        contributions=True)
+
+        # Robust statistics of every family, swept once; the sweeps themselves never write
+        _, metric_index = self.equity_calculator.get_metric_combinations()
+        allocations = data.loc[recipients].copy()
+        allocation_stats = self.equity_calculator.accumulate_run_statistics(self.allocation_shares, metric_index)
+        allocations["Robust_Share"] = allocation_stats.mean / np.nansum(allocation_stats.mean)
+        self.robust = {"allocations": (allocations, allocation_stats.to_frame())}
+        masks = [self.equity_calculator.get_donor_pool(*pool) for pool in DONOR_POOLS]
+        frames, stats = self.equity_calculator.calculate_robust_contributions_pools(masks, streaming=True)
+        for p, (pool, frame) in enumerate(zip(DONOR_POOLS, frames)):
+            self.robust[pool] = (frame, stats.to_frame(pool=p).loc[masks[p]])
+
+        if writer is not None:
+            self.equity_calculator.write_results("allocations", allocations, "Robust_Allocations_NCQG.csv")
+            for pool, frame in zip(DONOR_POOLS, frames):
+                extension = self.equity_calculator.get_donor_pool_extension(*pool)
+                self.equity_calculator.write_results("contributions" + extension, frame,
+                                                     "Robust_Contributions_NCQG" + extension + ".csv")
+            writer.flush()
+
+        self._answer = functools.lru_cache(maxsize=cache_size)(self._compute)
+        self.queries = 0
+        self._lock = threading.Lock()
+        self.startup_seconds = time.perf_counter() - start
+
+    def get_rows(self, mask):
+
+        data = self.equity_calculator.data.loc[mask]
+
+        return data[["ISO", "Country", "Region"]].to_dict(orient="records")
+
+    def normalise(self, kind, parameters):
+        """
+        Canonical, hashable form of the parameters of a query
+        Inputs:
+            kind: "allocations", "contributions" or "robust"
+            parameters: Dictionary of Responsibility .. Engagement (variable names), Responsibility_weight ..
+                Engagement_weight, total_value, include_UMIC and exclude_US; robust queries also take
+                measure ("allocations" or "contributions") and ignore the variables and weights. Variables default
+                to the first of their pillar, weights to 1 and the rest to the app defaults
+        Returns:
+            key: tuple (kind, variables, weights, total_value, donor pool)
+        """
+
+        unknown = set(parameters) - set(PILLARS + [p + "_weight" for p in PILLARS] + list(DEFAULTS) + ["measure"])
+        if unknown:
+            raise ValueError(f"Unknown parameters {sorted(unknown)}")
+        parameters = {**DEFAULTS, **parameters}
+
+        total_value = float(parameters["total_value"])
+        if not np.isfinite(total_value):
+            raise ValueError("total_value must be a finite number")
+        pool = (_parse_bool(parameters["include_UMIC"]), _parse_bool(parameters["exclude_US"]))
+
+        if kind == "robust":
+            measure = parameters.get("measure", "allocations")
+            if measure not in ("allocations", "contributions"):
+                raise ValueError(f"Unknown measure '{measure}'; expected 'allocations' or 'contributions'")
+            return (kind, measure, None, total_value, None if measure == "allocations" else pool)
+
+        # Contributions only use Responsibility and Capacity
+        pillars = PILLARS if kind == "allocations" else PILLARS[:2]
+        variables, weights = [], []
+        for pillar in pillars:
+            variable = parameters.get(pillar, self.variables[pillar][0])
+            if variable not in self.variables[pillar]:
+                raise ValueError(f"Unknown {pillar} variable '{variable}'; expected one of {self.variables[pillar]}")
+            weight = float(parameters.get(pillar + "_weight", 1))
+            if not 0 <= weight < np.inf:
+                raise ValueError(f"{pillar}_weight must be a finite, non-negative number")
+            variables.append(variable)
+            weights.append(weight)
+        if not 0 < sum(weights) < np.inf:
+            raise ValueError("At least one weight must be positive, and their sum finite")
+
+        return (kind, tuple(variables), tuple(weights), total_value, pool if kind == "contributions" else None)
+
+    def query(self, kind, parameters):
+        """
+        JSON answer (bytes) of one query, from the cache when the normalised parameters were seen before
+        """
+
+        with self._lock:
+            self.queries += 1
+
+        return self._answer(self.normalise(kind, parameters))
+
+    def _compute(self, key):
+
+        kind, variables, weights, total_value, pool = key
+
+        if kind == "robust":
+            frame, summary = self.robust["allocations" if variables == "allocations" else pool]
+            share_column = "Robust_Share" if variables == "allocations" else "Robust_Contribution"
+            columns = {share_column: frame[share_column].to_numpy()}
+            columns["Robust_USDbn"] = columns[share_column] * total_value
+            # Per-run bands on the same normalised scale as the robust share
+            scale = 1 / np.nansum(summary["Mean"].to_numpy())
+            columns.update({column: summary[column].to_numpy() * scale
+                            for column in ["Min", "P5", "P50", "P95", "Max"]})
+            rows = frame[["ISO", "Country", "Region"]].to_dict(orient="records")
+        else:
+            if kind == "allocations":
+                shares, rows, value_column = self.allocation_shares, self.allocation_rows, "Allocation_USDbn"
+            else:
+                shares, rows = self.contribution_shares[pool], self.contribution_rows[pool]
+                value_column = "Contributions_USDbn"
+            weight_matrix, positions = self.equity_calculator.get_batch_inputs(np.array([weights]), list(variables),
+                                                                               n_pillars=len(variables))
+            values = EquityCalculator.combine_batch(shares, weight_matrix, positions, total_value)[0]
+            columns = {value_column: values}
+
+        # NaN (e.g. a missing indicator) is not valid JSON
+        values = zip(*[[None if np.isnan(value) else value for value in column.tolist()]
+                       for column in columns.values()])
+        results = [{**row, **dict(zip(columns, row_values))} for row, row_values in zip(rows, values)]
+
+        parameters = {"kind": kind, "total_value": total_value}
+        if kind == "robust":
+            parameters["measure"] = variables
+        else:
+            parameters.update({pillar: variable for pillar, variable in zip(PILLARS, variables)})
+            parameters.update({pillar + "_weight": weight for pillar, weight in zip(PILLARS, weights)})
+        if pool is not None:
+            parameters.update(include_UMIC=pool[0], exclude_US=pool[1])
+
+        return json.dumps({"parameters": parameters, "results": results}, allow_nan=False).encode()
+
+    def get_status(self):
+
+        info = self._answer.cache_info()
+
+        return {"status": "ok", "countries": len(self.equity_calculator.data), "queries": self.queries,
+                "cache": {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize},
+                "startup_seconds": self.startup_seconds}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    GET /allocations, /contributions and /robust with the parameters of QueryEngine.normalise as query
+    string arguments (or POST them as a JSON object), and GET /health for the status and cache counters
+    """
+
+    engine = None
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+
+        url = urlsplit(self.path)
+        self.respond(url.path, dict(parse_qsl(url.query)))
+
+    def do_POST(self):
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            parameters = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(parameters, dict):
+                raise ValueError("Expected a JSON object of parameters")
+        except ValueError as error:
+            self.send_json(400, {"error": str(error)})
+            return
+
+        self.respond(urlsplit(self.path).path, parameters)
+
+    def respond(self, path, parameters):
+
+        kind = path.strip("/")
+        if kind == "health":
+            self.send_json(200, self.engine.get_status())
+        elif kind in ("allocations", "contributions", "robust"):
+            try:
+                self.send_body(200, self.engine.query(kind, parameters))
+            except ValueError as error:
+                self.send_json(400, {"error": str(error)})
+            except Exception as error:
+                self.send_json(500, {"error": f"{type(error).__name__}: {error}"})
+        else:
+            self.send_json(404, {"error": f"Unknown path '{path}'; expected /allocations, /contributions, "
+                                         "/robust or /health"})
+
+    def send_json(self, status, payload):
+
+        self.send_body(status, json.dumps(payload).encode())
+
+    def send_body(self, status, body):
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+
+        # Per-request logging on stderr costs more than answering a cached query
+        pass
+
+
+class QueryServer(ThreadingHTTPServer):
+
+    # One thread per connection; a deeper listen backlog keeps bursts of clients from waiting on SYN retries
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def create_server(engine, host="127.0.0.1", port=8000):
+    """
+    Threaded HTTP server answering queries from engine; call serve_forever() to start it
+    """
+
+    handler = type("BoundQueryHandler", (QueryHandler,), {"engine": engine})
+
+    return QueryServer((host, port), handler)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local HTTP service answering allocation, contribution and "
+                                                 "robust-summary queries from one pre-warmed dataset")
+    parser.add_argument("--data", default="NCQG Data.xlsx", help="NCQG workbook")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-size", type=int, default=4096, help="Maximum number of cached answers")
+    parser.add_argument("--output-dir", default=None, help="Also write the robust results to this directory as Parquet")
+    args = parser.parse_args()
+
+    engine = QueryEngine(args.data, cache_size=args.cache_size, output_dir=args.output_dir)
+    server = create_server(engine, args.host, args.port)
+    print(f"Ready in {engine.startup_seconds:.1f} s; serving on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+
+def calculate_ranks(runs):
+    """
+    Rank of every country in every run, 1 being the largest share
+    Inputs:
+        runs: numpy array (runs x countries) of shares
+    Returns:
+        ranks: int32 numpy array (runs x countries); missing shares rank last, and ties keep country order
+    """
+
+    runs = np.asarray(runs, dtype=float)
+    order = np.argsort(-np.where(np.isnan(runs), -np.inf, runs), axis=1, kind="stable")
+
+    ranks = np.empty(runs.shape, dtype=np.int32)
+    np.put_along_axis(ranks, order, np.arange(1, runs.shape[1] + 1, dtype=np.int32)[None, :], axis=1)
+
+    return ranks
+
+
+def calculate_rank_distribution(ranks, max_rank=None):
+    """
+    Share of runs in which each country holds each rank, counted with one bincount
+    Inputs:
+        ranks: numpy array (runs x countries) from calculate_ranks
+        max_rank: Highest rank to tabulate (defaults to the number of countries)
+    Returns:
+        distribution: numpy array (countries x max_rank); row i, column r is the probability of rank r + 1
+    """
+
+    n_runs, n_countries = ranks.shape
+    max_rank = n_countries if max_rank is None else min(max_rank, n_countries)
+
+    held = ranks <= max_rank
+    cells = (np.arange(n_countries, dtype=np.int64)[None, :] * max_rank + ranks - 1)[held]
+    counts = np.bincount(cells, minlength=n_countries * max_rank)
+
+    return counts.reshape(n_countries, max_rank) / max(n_runs, 1)
+
+
+def calculate_rank_stability(runs, index=None, top_n=(1, 5, 10, 20), quantiles=(0.05, 0.5, 0.95), max_rank=None):
+    """
+    Rank-stability report of a (runs x countries) share matrix
+    Inputs:
+        runs: numpy array (runs x countries), e.g. ScenarioResults.runs
+        index: Row labels, e.g. the ISO codes of the countries
+        top_n: Sizes N of the top-N probabilities
+        quantiles: Quantiles of the rank and share bands
+        max_rank: Highest rank in the distribution (defaults to the number of countries)
+    Returns:
+        report: pandas dataframe with one row per country: Mean_Rank, Best_Rank, Worst_Rank, Rank_P{q},
+            P_Top{N} (share of runs in which the country ranks N or better) and Share_P{q}
+        distribution: pandas dataframe (countries x ranks 1..max_rank) of rank probabilities
+    """
+
+    runs = np.asarray(runs, dtype=float)
+    ranks = calculate_ranks(runs)
+
+    report = pd.DataFrame({
+        "Mean_Rank": ranks.mean(axis=0),
+        "Best_Rank": ranks.min(axis=0),
+        "Worst_Rank": ranks.max(axis=0),
+    }, index=index)
+
+    # Exact order statistics of the ranks and the shares
+    for q, values in zip(quantiles, np.quantile(ranks, list(quantiles), axis=0, method="inverted_cdf")):
+        report[f"Rank_P{q * 100:g}"] = values.astype(np.int32)
+    for n in top_n:
+        report[f"P_Top{n}"] = (ranks <= n).mean(axis=0)
+    for q, values in zip(quantiles, np.nanquantile(runs, list(quantiles), axis=0)):
+        report[f"Share_P{q * 100:g}"] = values
+
+    distribution = calculate_rank_distribution(ranks, max_rank)
+
+    return report, pd.DataFrame(distribution, index=index, columns=np.arange(1, distribution.shape[1] + 1))
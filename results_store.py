@@ -0,0 +1,264 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from equity_calculator import generate_weight_combos
+from rank_stability import calculate_rank_stability
+
+
+# Next to this module, so that every entry point shares one store whatever its working directory
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+class ScenarioResults:
+    """
+    Read-only view of one scenario family (e.g. "allocations" or "contributions_UMIC").
+
+    runs is a memory-mapped (run x country) array, so selecting a run, a country or any subset is
+    a zero-copy slice. Runs are laid out metric combination first then weights, so the row of a
+    (metric combination, weight vector) pair is found with two dictionary lookups.
+    """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.runs = np.load(os.path.join(directory, "runs.npy"), mmap_mode="r")
+        self.robust = np.load(os.path.join(directory, "robust.npy"), mmap_mode="r")
+
+        with np.load(os.path.join(directory, "index.npz"), allow_pickle=False) as index:
+            self.country = index["country"]
+            self.iso = index["iso"]
+            self.region = index["region"]
+            self.metric_names = index["metric_names"]
+            self.weight_combos = index["weight_combos"]
+
+        self.country_index = {iso: i for i, iso in enumerate(self.iso)}
+        self.metric_index = {tuple(names): m for m, names in enumerate(self.metric_names)}
+        self.weight_index = {self._weight_key(weights): w for w, weights in enumerate(self.weight_combos)}
+        self._rank_stability = {}
+
+    @staticmethod
+    def _weight_key(weights):
+        return tuple(np.round(np.asarray(weights, dtype=float), 9))
+
+    def get_run_index(self, metric_names, weights):
+        """
+        Row of the run with the given (responsibility, capacity, needs, engagement) metrics and weights
+        """
+
+        m = self.metric_index[tuple(metric_names)]
+        w = self.weight_index[self._weight_key(weights)]
+
+        return m * len(self.weight_combos) + w
+
+    def _row(self, run):
+        if isinstance(run, str):
+            number = int(run.removeprefix("RUN"))
+            if not 1 <= number <= len(self.runs):
+                raise KeyError(f"No run '{run}': runs are numbered RUN1 to RUN{len(self.runs)}")
+            return number - 1
+        return run
+
+    def get_run(self, run):
+        """
+        Shares of every country in one run, given as a row number or a "RUN{n}" name
+        """
+
+        return self.runs[self._row(run)]
+
+    def get_country(self, iso):
+        """
+        Shares of one country across every run
+        """
+
+        return self.runs[:, self.country_index[iso]]
+
+    def get_value(self, run, iso):
+        """
+        Share of one country in one run, e.g. get_value("RUN731", "KEN")
+        """
+
+        return float(self.runs[self._row(run), self.country_index[iso]])
+
+    def select(self, runs=None, countries=None):
+        """
+        Subset of runs (rows or "RUN{n}" names) and countries (ISO codes); contiguous slices are zero-copy
+        """
+
+        rows = slice(None) if runs is None else runs
+        if not isinstance(rows, slice):
+            rows = [self._row(run) for run in rows]
+        columns = slice(None) if countries is None else [self.country_index[iso] for iso in countries]
+
+        # Basic slicing keeps a view of the memory map; lists of rows or countries copy only the selection
+        if isinstance(rows, slice) and isinstance(columns, slice):
+            return self.runs[rows, columns]
+
+        return self.runs[rows][:, columns]
+
+    def to_frame(self, value_col="Robust_Share"):
+        """
+        Country, ISO and Region with the robust (mean, rescaled) share in value_col
+        """
+
+        return pd.DataFrame({
+            "Country": self.country,
+            "ISO": self.iso,
+            "Region": self.region,
+            value_col: np.asarray(self.robust),
+        })
+
+    def rank_stability(self, top_n=(1, 5, 10, 20), quantiles=(0.05, 0.5, 0.95)):
+        """
+        How stable each country's rank is across every stored run; computed once per argument set,
+        and returned as copies that callers may modify
+        Returns:
+            report: to_frame() with the rank and share bands of rank_stability.calculate_rank_stability,
+                the share bands rescaled like the robust share
+            distribution: pandas dataframe (countries x ranks) of rank probabilities, indexed by ISO
+        """
+
+        key = (tuple(top_n), tuple(quantiles))
+        if key not in self._rank_stability:
+            report, distribution = calculate_rank_stability(self.runs, self.iso, top_n, quantiles)
+
+            # Per-run bands on the same normalised scale as the robust share
+            scale = 1 / np.nansum(np.mean(self.runs, axis=0))
+            share_columns = [column for column in report.columns if column.startswith("Share_P")]
+            report[share_columns] = report[share_columns] * scale
+
+            report = pd.concat([self.to_frame().set_index("ISO", drop=False), report], axis=1)
+            self._rank_stability[key] = (report.reset_index(drop=True), distribution)
+
+        report, distribution = self._rank_stability[key]
+
+        return report.copy(), distribution.copy()
+
+
+class ResultsStore:
+    """
+    Persistent store of robust run results, one directory per scenario family, tagged with the data
+    version (workbook hash) they were computed from.
+    """
+
+    def __init__(self, directory=RESULTS_DIR):
+
+        self.directory = directory
+        self._opened = {}
+
+    def _metadata_path(self):
+        return os.path.join(self.directory, "metadata.json")
+
+    def get_metadata(self):
+
+        if not os.path.exists(self._metadata_path()):
+            return {"families": {}}
+        with open(self._metadata_path()) as f:
+            return json.load(f)
+
+    def has(self, family, data_version=None):
+        """
+        Whether the family is stored (for the given data version, if any)
+        """
+
+        entry = self.get_metadata()["families"].get(family)
+        return entry is not None and (data_version is None or entry["data_version"] == data_version)
+
+    def write(self, family, data, runs, robust, metric_names, weight_combos, data_version=None):
+        """
+        Store one scenario family
+        Inputs:
+            family: Name, e.g. "allocations" or "contributions_UMIC"
+            data: pandas dataframe with Country, ISO and Region for the countries in runs
+            runs: numpy array (runs x countries), ordered metric combination first then weights
+            robust: numpy array (countries) with the robust share
+            metric_names: numpy array (metric combos x 4) of variable names
+            weight_combos: numpy array (weight combos x 4)
+            data_version: Version (hash) of the data the runs were computed from
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        temp_directory = tempfile.mkdtemp(prefix=f".{family}.", dir=self.directory)
+
+        np.save(os.path.join(temp_directory, "runs.npy"), np.ascontiguousarray(runs, dtype=np.float64))
+        np.save(os.path.join(temp_directory, "robust.npy"), np.asarray(robust, dtype=np.float64))
+        np.savez(os.path.join(temp_directory, "index.npz"),
+                 country=data["Country"].to_numpy(dtype=str),
+                 iso=data["ISO"].to_numpy(dtype=str),
+                 region=data["Region"].to_numpy(dtype=str),
+                 metric_names=np.asarray(metric_names, dtype=str),
+                 weight_combos=np.asarray(weight_combos, dtype=np.float64))
+
+        # Swap the new directory into place
+        self._opened.pop(family, None)
+        family_directory = os.path.join(self.directory, family)
+        if os.path.exists(family_directory):
+            shutil.rmtree(family_directory)
+        os.replace(temp_directory, family_directory)
+
+        metadata = self.get_metadata()
+        metadata["families"][family] = {"data_version": data_version, "runs": int(runs.shape[0]),
+                                        "countries": int(runs.shape[1])}
+        with open(self._metadata_path(), "w") as f:
+            json.dump(metadata, f, indent=2)
+
+    def open(self, family):
+        """
+        Memory-map a stored family; repeated opens return the same view
+        """
+
+        if family not in self._opened:
+            if not self.has(family):
+                raise KeyError(f"No results stored for '{family}' in {self.directory}")
+            self._opened[family] = ScenarioResults(os.path.join(self.directory, family))
+
+        return self._opened[family]
+
+    def build(self, equity_calculator, data_version=None, resolution=10, allow_zero=False):
+        """
+        Run the robust allocation and all four donor-pool contribution sweeps and store them as the
+        "allocations" and "contributions{extension}" families
+        """
+
+        metric_names, metric_index = equity_calculator.get_metric_combinations()
+        weight_combos = generate_weight_combos(resolution, allow_zero=allow_zero)
+
+        # Allocations to recipients
+        data = equity_calculator.data.loc[equity_calculator.data["AnnexII_countries"] == 0]
+        shares = equity_calculator.normalise_indicators(data)
+        runs = equity_calculator.calculate_run_shares(shares, metric_index, weight_combos)
+        robust = runs.mean(axis=0)
+        self.write("allocations", data, runs, robust / robust.sum(), metric_names, weight_combos, data_version)
+
+        # Contributions for every donor pool
+        pools = equity_calculator.get_donor_pools()
+        masks = np.array(list(pools.values()))
+        shares = equity_calculator.normalise_indicators(equity_calculator.data, contributions=True, masks=masks)
+        runs = equity_calculator.calculate_run_shares(shares, metric_index, weight_combos)
+        for p, (extension, mask) in enumerate(pools.items()):
+            pool_runs = runs[p][:, mask]
+            robust = pool_runs.mean(axis=0)
+            self.write("contributions" + extension, equity_calculator.data.loc[mask], pool_runs,
+                       robust / robust.sum(), metric_names, weight_combos, data_version)
+
+        return self
+
+
+if __name__ == "__main__":
+
+    from equity_calculator import EquityCalculator
+
+    # Check that the share bands of every family bracket the robust share they are plotted against
+    equity_calculator = EquityCalculator("NCQG Data.xlsx", fast_load=True)
+    with tempfile.TemporaryDirectory() as directory:
+        store = ResultsStore(directory).build(equity_calculator)
+        for family in ["allocations", "contributions", "contributions_US", "contributions_UMIC",
+                       "contributions_UMIC_US"]:
+            report, _ = store.open(family).rank_stability()
+            assert (report["Share_P5"] <= report["Robust_Share"] * (1 + 1e-12)).all(), family
+            assert (report["Robust_Share"] <= report["Share_P95"] * (1 + 1e-12)).all(), family
+
+    print("Share bands bracket the robust share in every family")
@@ -0,0 +1,217 @@
+import numpy as np
+
+from equity_calculator import EquityCalculator
+
+
+class Scenario:
+    """
+    Stateful, incremental version of calculate_weighted_equity and calculate_contributions.
+
+    Normalised share vectors are cached per (indicator, country subset), and update() only redoes the
+    stages affected by what changed: a new metric in one pillar replaces that pillar's column, a new
+    weight redoes the weighted combination, and a new total only rescales. Output frames have the same
+    columns as the EquityCalculator methods and are built lazily on first access.
+    """
+
+    def __init__(self, equity_calculator):
+
+        self.equity_calculator = equity_calculator
+        self.pillars = ["Responsibility", "Capacity", "Needs", "Engagement"]
+        self.positions = {variable: i for i, variable in enumerate(equity_calculator.variable_dict)}
+        self._subsets = {}
+
+        # Current inputs
+        self.weights = None
+        self.variable_columns = [None] * len(self.pillars)
+        self.total_value = None
+        self.donor_pool = None
+
+        # Cached stages: pillar share columns, weighted score and scaled values
+        self._allocation_columns = None
+        self._allocation_score = None
+        self._allocation_values = None
+        self._contribution_columns = None
+        self._contribution_weights = None
+        self._contribution_score = None
+        self._contribution_values = None
+        self._allocations = None
+        self._contributions = None
+
+        # Stages recomputed by the last update, for inspection
+        self.recomputed = []
+
+    def get_subset(self, key):
+        """
+        Rows and normalised share matrix (countries x indicators) for a country subset, computed once.
+        key is "recipients" or ("donors", include_UMIC, exclude_US).
+        """
+
+        if key not in self._subsets:
+            if key == "recipients":
+                data = self.equity_calculator.data.loc[self.equity_calculator.data["AnnexII_countries"] == 0]
+                shares = self.equity_calculator.normalise_indicators(data)
+            else:
+                data = self.equity_calculator.data.loc[self.equity_calculator.get_donor_pool(*key[1:])]
+                shares = self.equity_calculator.normalise_indicators(data, contributions=True)
+            self._subsets[key] = (data, shares)
+
+        return self._subsets[key]
+
+    def update(self, weights=None, variable_columns=None, total_value=None, include_UMIC=None, exclude_US=None):
+        """
+        Set new inputs and recompute only the affected stages
+        Inputs:
+            weights: Dictionary of weights per pillar (Responsibility, Capacity, Needs, Engagement)
+            variable_columns: List of selected variable names per pillar
+            total_value: Total climate finance value (USDbn)
+            include_UMIC, exclude_US: Donor pool for contributions
+            Arguments left as None keep their previous values
+        Returns:
+            self
+        """
+
+        self.recomputed = []
+        weights = self.weights if weights is None else dict(weights)
+        variable_columns = self.variable_columns if variable_columns is None else list(variable_columns)
+        total_value = self.total_value if total_value is None else total_value
+        previous_pool = self.donor_pool or ("donors", None, None)
+        include_UMIC = previous_pool[1] if include_UMIC is None else include_UMIC
+        exclude_US = previous_pool[2] if exclude_US is None else exclude_US
+        donor_pool = ("donors", include_UMIC, exclude_US)
+
+        changed_pillars = [p for p in range(len(self.pillars))
+                           if self._allocation_columns is None or variable_columns[p] != self.variable_columns[p]]
+        weights_changed = weights != self.weights
+        total_changed = total_value != self.total_value
+        pool_changed = donor_pool != self.donor_pool
+
+        self.weights, self.variable_columns = weights, variable_columns
+        self.total_value, self.donor_pool = total_value, donor_pool
+
+        # Nothing can be computed until every input is set; start afresh once it is
+        if weights is None or total_value is None or None in variable_columns:
+            self._allocation_columns = self._contribution_columns = None
+            self._allocation_values = self._contribution_values = None
+            return self
+
+        weight_values = np.array(list(weights.values()), dtype=float)
+
+        # Allocations to recipients
+        if changed_pillars:
+            data, shares = self.get_subset("recipients")
+            if self._allocation_columns is None:
+                self._allocation_columns = np.empty((len(data), len(self.pillars)))
+            for p in changed_pillars:
+                self._allocation_columns[:, p] = shares[:, self.positions[variable_columns[p]]]
+                self.recomputed.append(f"allocation_column_{self.pillars[p]}")
+
+        # Weighted through combine_batch, pillar by pillar, so that scores match calculate_weighted_equity exactly
+        if changed_pillars or weights_changed:
+            self._allocation_score = self.combine(self._allocation_columns, weight_values)
+            self.recomputed.append("allocation_score")
+
+        if changed_pillars or weights_changed or total_changed:
+            self._allocation_values = self._allocation_score * total_value
+            self._allocations = None
+            self.recomputed.append("allocation_values")
+
+        # Contributions, from the Responsibility and Capacity pillars only
+        contribution_pillars = [p for p in changed_pillars if p < 2]
+        if pool_changed or self._contribution_columns is None:
+            contribution_pillars = [0, 1]
+
+        if contribution_pillars:
+            data, shares = self.get_subset(donor_pool)
+            if pool_changed or self._contribution_columns is None:
+                self._contribution_columns = np.empty((len(data), 2))
+            for p in contribution_pillars:
+                self._contribution_columns[:, p] = shares[:, self.positions[variable_columns[p]]]
+                self.recomputed.append(f"contribution_column_{self.pillars[p]}")
+
+        contribution_weights = list(weights.values())[:2]
+        contribution_weights_changed = contribution_weights != self._contribution_weights
+        if contribution_pillars or contribution_weights_changed:
+            self._contribution_weights = contribution_weights
+            self._contribution_score = self.combine(self._contribution_columns, weight_values[:2])
+            self.recomputed.append("contribution_score")
+
+        if contribution_pillars or contribution_weights_changed or total_changed:
+            self._contribution_values = self._contribution_score * total_value
+            self._contributions = None
+            self.recomputed.append("contribution_values")
+
+        return self
+
+    @staticmethod
+    def combine(columns, weight_values):
+
+        positions = np.arange(columns.shape[1])[None, :]
+
+        return EquityCalculator.combine_batch(columns, weight_values[None, :], positions, 1.0)[0]
+
+    @property
+    def allocations(self):
+        """
+        Recipient allocations with the same columns as calculate_weighted_equity, or None until all inputs are set
+        """
+
+        if self._allocation_values is None or None in self.variable_columns:
+            return None
+
+        if self._allocations is None:
+            data, shares = self.get_subset("recipients")
+            equity_columns = [self.equity_calculator.variable_dict[k] for k in self.variable_columns]
+            frame = data[self.equity_calculator.identity_columns + equity_columns].copy()
+            for p, column in enumerate(equity_columns):
+                frame[column + "_share"] = self._allocation_columns[:, p]
+            frame["Weighted_Equity_Score"] = self._allocation_score
+            frame["Allocation_USDbn"] = self._allocation_values
+            self._allocations = frame
+
+        return self._allocations
+
+    @property
+    def contributions(self):
+        """
+        Donor contributions with the same columns as calculate_contributions, or None until all inputs are set
+        """
+
+        if self._contribution_values is None or None in self.variable_columns:
+            return None
+
+        if self._contributions is None:
+            data, shares = self.get_subset(self.donor_pool)
+            equity_columns = [self.equity_calculator.variable_dict[k] for k in self.variable_columns[0:2]]
+            frame = data[self.equity_calculator.identity_columns + equity_columns].copy()
+            for p, column in enumerate(equity_columns):
+                frame[column + "_contribution"] = self._contribution_columns[:, p]
+            frame["Weighted_Contributions_Score"] = self._contribution_score
+            frame["Contributions_USDbn"] = self._contribution_values
+            self._contributions = frame
+
+        return self._contributions
+
+
+if __name__ == "__main__":
+
+    # Check the incremental stages against the DataFrame methods on the workbook
+    equity_calculator = EquityCalculator("NCQG Data.xlsx", fast_load=True)
+    weights = {"Responsibility": 2, "Capacity": 3, "Needs": 1, "Engagement": 4}
+    variables = ["Cumulative Emissions since 1950", "Gross National Income per capita",
+                 "Physical Climate Risk (EIB)", "UN Multilateral Engagement Score"]
+
+    scenario = Scenario(equity_calculator).update(weights, variables, 300, include_UMIC=True, exclude_US=True)
+    donors = scenario.contributions["ISO"].tolist()
+
+    # A new total keeps the donor pool and only rescales
+    scenario.update(total_value=400)
+    assert scenario.recomputed == ["allocation_values", "contribution_values"], scenario.recomputed
+    assert scenario.contributions["ISO"].tolist() == donors
+
+    expected = equity_calculator.calculate_weighted_equity(weights, variables, 400)
+    assert np.array_equal(scenario.allocations["Allocation_USDbn"].to_numpy(), expected["Allocation_USDbn"].to_numpy())
+    expected = equity_calculator.calculate_contributions(weights, variables, 400, include_UMIC=True, exclude_US=True)
+    assert np.array_equal(scenario.contributions["Contributions_USDbn"].to_numpy(),
+                          expected["Contributions_USDbn"].to_numpy())
+
+    print(f"Scenario matches the DataFrame methods ({len(donors)} donors kept after a total-only update)")
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+
+class SensitivityAnalysis:
+    """
+    Variance-based (Sobol) sensitivity of each country's share to the pillar weights and to the
+    metric picked within each pillar.
+
+    The factors are one weight per pillar, drawn uniformly from weight_bounds and normalised by their
+    sum as in calculate_weighted_equity, and one metric choice per pillar with more than one metric,
+    drawn uniformly from the pillar's dictionary. Indices use Saltelli sampling with the Saltelli (2010)
+    first-order and Jansen total-order estimators, and every sample is evaluated in one batched
+    einsum over the normalised indicator matrix.
+    """
+
+    def __init__(self, equity_calculator, contributions=False, include_UMIC=None, exclude_US=None,
+                 weight_bounds=(0.0, 1.0)):
+        """
+        Inputs:
+            equity_calculator: EquityCalculator with the loaded data
+            contributions: If True, analyse contribution shares of the donor pool instead of recipient allocations
+            include_UMIC, exclude_US: Donor pool, as in calculate_contributions
+            weight_bounds: Range of the raw (unnormalised) weight of each pillar
+        """
+
+        self.equity_calculator = equity_calculator
+        self.weight_bounds = weight_bounds
+
+        if contributions:
+            self.data = equity_calculator.data.loc[equity_calculator.get_donor_pool(include_UMIC, exclude_US)]
+        else:
+            self.data = equity_calculator.data.loc[equity_calculator.data["AnnexII_countries"] == 0]
+        self.shares = equity_calculator.normalise_indicators(self.data, contributions=contributions)
+        self.shares = np.where(np.isnan(self.shares), 0.0, self.shares)
+
+        # Column of each pillar's metrics in the share matrix
+        positions = {variable: i for i, variable in enumerate(equity_calculator.variable_dict)}
+        self.pillars = {
+            "Responsibility": equity_calculator.responsibility_dict,
+            "Capacity": equity_calculator.capacity_dict,
+            "Needs": equity_calculator.needs_dict,
+            "Engagement": equity_calculator.engagement_dict,
+        }
+        self.metric_columns = {pillar: np.array([positions[name] for name in metrics])
+                               for pillar, metrics in self.pillars.items()}
+
+        self.factors = [f"w_{pillar}" for pillar in self.pillars] + \
+            [f"metric_{pillar}" for pillar, columns in self.metric_columns.items() if len(columns) > 1]
+
+    def sample(self, n, seed=None):
+        """
+        Saltelli sample matrices A and B of shape (n x factors) on the unit hypercube
+        """
+
+        rng = np.random.default_rng(seed)
+        return rng.random((n, len(self.factors))), rng.random((n, len(self.factors)))
+
+    def evaluate(self, samples):
+        """
+        Share of every country for every sample
+        Inputs:
+            samples: numpy array (samples x factors) on the unit hypercube
+        Returns:
+            shares: numpy array (samples x countries)
+        """
+
+        low, high = self.weight_bounds
+        weights = low + samples[:, :len(self.pillars)] * (high - low)
+
+        # Pick the metric of each pillar from its factor, or its only metric
+        columns = np.empty_like(weights, dtype=np.int64)
+        factor = len(self.pillars)
+        for p, (pillar, options) in enumerate(self.metric_columns.items()):
+            if len(options) > 1:
+                choice = np.minimum((samples[:, factor] * len(options)).astype(np.int64), len(options) - 1)
+                columns[:, p] = options[choice]
+                factor += 1
+            else:
+                columns[:, p] = options[0]
+
+        # (countries x samples x pillars) weighted by (samples x pillars)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.einsum("csp,sp->sc", self.shares[:, columns], weights) / weights.sum(axis=1)[:, None]
+
+    def calculate_sobol_indices(self, n=4096, seed=None, groups=None):
+        """
+        First-order and total-order Sobol indices of each country's share
+        Inputs:
+            n: Base sample size; the model is evaluated n x (factors + 2) times
+            seed: Random seed
+            groups: Optional dictionary of group name -> list of factors, to compute indices for
+                groups of factors (e.g. all weights vs all metric choices) instead of single factors
+        Returns:
+            first_order: pandas dataframe (countries x factors or groups) indexed by ISO
+            total_order: pandas dataframe (countries x factors or groups) indexed by ISO
+        """
+
+        if groups is None:
+            groups = {factor: [factor] for factor in self.factors}
+
+        A, B = self.sample(n, seed)
+        f_A = self.evaluate(A)
+        f_B = self.evaluate(B)
+        variance = np.var(np.concatenate([f_A, f_B]), axis=0)
+
+        first_order, total_order = {}, {}
+        for name, factors in groups.items():
+            columns = [self.factors.index(factor) for factor in factors]
+            AB = A.copy()
+            AB[:, columns] = B[:, columns]
+            f_AB = self.evaluate(AB)
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                first_order[name] = np.mean(f_B * (f_AB - f_A), axis=0) / variance
+                total_order[name] = 0.5 * np.mean((f_A - f_AB) ** 2, axis=0) / variance
+
+        index = pd.Index(self.data["ISO"], name="ISO")
+
+        return pd.DataFrame(first_order, index=index), pd.DataFrame(total_order, index=index)
+
+    def calculate_grouped_indices(self, n=4096, seed=None):
+        """
+        Sobol indices for the pillar weights as one group against the metric choices as another
+        """
+
+        groups = {
+            "Pillar weights": [factor for factor in self.factors if factor.startswith("w_")],
+            "Metric choices": [factor for factor in self.factors if factor.startswith("metric_")],
+        }
+
+        return self.calculate_sobol_indices(n, seed, groups)
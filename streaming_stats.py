@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+
+
+class StreamingStatistics:
+    """
+    Constant-memory per-country statistics over a stream of runs.
+
+    Runs are added in batches of shape (runs, *shape), e.g. (runs x countries) or
+    (runs x pools x countries). Mean and variance use Chan's parallel update, min/max are
+    exact, and quantiles come from a merging t-digest with n_centroids centroids per country.
+    Missing values (NaN) are skipped. Memory depends on shape and n_centroids, never on the
+    number of runs, and two accumulators over the same shape can be merged.
+    """
+
+    def __init__(self, shape, n_centroids=100):
+
+        self.shape = tuple(int(n) for n in np.atleast_1d(shape))
+        self.n_centroids = n_centroids
+        size = int(np.prod(self.shape))
+
+        self.count = np.zeros(size)
+        self._mean = np.zeros(size)
+        self._m2 = np.zeros(size)
+        self._min = np.full(size, np.inf)
+        self._max = np.full(size, -np.inf)
+        self._centroid_means = np.full((size, n_centroids), np.nan)
+        self._centroid_weights = np.zeros((size, n_centroids))
+
+    def update(self, batch):
+        """
+        Add a batch of runs with shape (runs, *shape)
+        """
+
+        batch = np.asarray(batch, dtype=float).reshape(-1, self.count.size)
+        valid = ~np.isnan(batch)
+        count = valid.sum(axis=0)
+        if not count.any():
+            return self
+
+        # Moments of the batch
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.nansum(batch, axis=0) / count
+            m2 = np.nansum((batch - mean) ** 2, axis=0)
+        self._combine(count, np.nan_to_num(mean), m2)
+
+        self._min = np.fmin(self._min, np.nanmin(np.where(valid, batch, np.inf), axis=0))
+        self._max = np.fmax(self._max, np.nanmax(np.where(valid, batch, -np.inf), axis=0))
+        self._compress(batch.T, valid.T.astype(float))
+
+        return self
+
+    def merge(self, other):
+        """
+        Combine the statistics of another accumulator over the same shape into this one
+        """
+
+        if other.shape != self.shape:
+            raise ValueError(f"Cannot merge statistics of shape {other.shape} into {self.shape}")
+
+        self._combine(other.count, other._mean, other._m2)
+        self._min = np.fmin(self._min, other._min)
+        self._max = np.fmax(self._max, other._max)
+        self._compress(other._centroid_means, other._centroid_weights)
+
+        return self
+
+    def _combine(self, count, mean, m2):
+
+        total = self.count + count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = mean - self._mean
+            self._mean = np.where(total > 0, self._mean + delta * count / total, 0.0)
+            self._m2 = np.where(total > 0, self._m2 + m2 + delta ** 2 * self.count * count / total, 0.0)
+        self.count = total
+
+    def _compress(self, values, weights):
+
+        # Merge the new points with the existing centroids, sorted per country
+        values = np.concatenate([self._centroid_means, values], axis=1)
+        weights = np.concatenate([self._centroid_weights, weights], axis=1)
+        order = np.argsort(np.where(weights > 0, values, np.inf), axis=1)
+        values = np.take_along_axis(values, order, axis=1)
+        weights = np.take_along_axis(weights, order, axis=1)
+
+        # Assign each point to a centroid by its quantile on the t-digest (arcsine) scale,
+        # which keeps centroids small in the tails
+        cumulative = np.cumsum(weights, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            q = np.clip((cumulative - weights / 2) / cumulative[:, -1:], 0, 1)
+        k = np.floor((np.arcsin(2 * np.nan_to_num(q) - 1) / np.pi + 0.5) * self.n_centroids)
+        bins = np.clip(k, 0, self.n_centroids - 1).astype(np.int64)
+        bins += np.arange(len(bins))[:, None] * self.n_centroids
+
+        size = self._centroid_weights.size
+        totals = np.bincount(bins.ravel(), weights=weights.ravel(), minlength=size)
+        sums = np.bincount(bins.ravel(), weights=np.where(weights > 0, weights * values, 0.0).ravel(), minlength=size)
+
+        self._centroid_weights = totals.reshape(self._centroid_weights.shape)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self._centroid_means = np.where(self._centroid_weights > 0, sums.reshape(self._centroid_weights.shape)
+                                            / self._centroid_weights, np.nan)
+
+    @property
+    def mean(self):
+        return np.where(self.count > 0, self._mean, np.nan).reshape(self.shape)
+
+    @property
+    def variance(self):
+        """Sample variance (ddof=1)"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, self._m2 / (self.count - 1), np.nan).reshape(self.shape)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def standard_error(self):
+        """Standard error of the mean"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.std / np.sqrt(self.count.reshape(self.shape))
+
+    @property
+    def min(self):
+        return np.where(self.count > 0, self._min, np.nan).reshape(self.shape)
+
+    @property
+    def max(self):
+        return np.where(self.count > 0, self._max, np.nan).reshape(self.shape)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.count, self._mean, self._m2, self._min, self._max,
+                                      self._centroid_means, self._centroid_weights))
+
+    def quantile(self, q):
+        """
+        Approximate quantile(s) q in [0, 1]
+        Returns:
+            numpy array of shape (*shape) for a scalar q, or (len(q), *shape)
+        """
+
+        scalar = np.ndim(q) == 0
+        q = np.atleast_1d(np.asarray(q, dtype=float))
+        result = np.full((len(q), self.count.size), np.nan)
+
+        for i in np.flatnonzero(self.count > 0):
+            weights = self._centroid_weights[i]
+            filled = weights > 0
+            cumulative = np.cumsum(weights[filled])
+            positions = np.concatenate([[0.0], (cumulative - weights[filled] / 2) / cumulative[-1], [1.0]])
+            values = np.concatenate([[self._min[i]], self._centroid_means[i][filled], [self._max[i]]])
+            result[:, i] = np.interp(q, positions, values)
+
+        result = result.reshape((len(q),) + self.shape)
+
+        return result[0] if scalar else result
+
+    def to_frame(self, index=None, quantiles=(0.05, 0.5, 0.95), pool=None):
+        """
+        Summary table with one row per country
+        Inputs:
+            index: Row labels, e.g. the ISO codes of the countries
+            quantiles: Approximate quantiles to include as P{q} columns
+            pool: For (pools x countries) statistics, the pool to tabulate
+        """
+
+        def select(values):
+            values = np.asarray(values).reshape((-1,) + self.shape)
+            return values[(slice(None), pool)] if pool is not None else values
+
+        columns = {
+            "Runs": self.count.reshape(self.shape),
+            "Mean": self.mean,
+            "Std": self.std,
+            "Min": self.min,
+            "Max": self.max,
+        }
+        frame = pd.DataFrame({name: select(values)[0] for name, values in columns.items()}, index=index)
+        for q, values in zip(quantiles, select(self.quantile(list(quantiles)))):
+            frame[f"P{q * 100:g}"] = values
+
+        return frame
@@ -1,8 +1,8 @@
 import streamlit as st
 from  streamlit_vertical_slider import vertical_slider 
-from equity_calculator import EquityCalculator
 from visualiser import Visualiser
-from postprocessor import Data
+from scenario import Scenario
+from calculator_cache import get_calculator, get_data_version, get_results_store, start_results_store
 
 st.title(":earth_africa: Equity in Climate Finance Calculator")
 st.write(
@@ -17,41 +17,81 @@ with col2:
     include_UMIC = st.checkbox("Include UMIC as contributors", value=True, key="Include_UMIC")
 
 # Call visualiser and equity calculator classes
-equity_calculator = EquityCalculator(data="NCQG Data.xlsx")
+equity_calculator = get_calculator("NCQG Data.xlsx")
+data_version = get_data_version("NCQG Data.xlsx")
 visualiser = Visualiser()
+
+# Robust results are loaded (or computed) once per data version on a background thread
+results_future = start_results_store(data_version)
+
 tab0, tab1, tab2, tab3, tab4, tab5 = st.tabs(["📍 Weighting", "📊 Allocations", "📈 Contributions", "🗺️ Regional Distribution" , "🌐 Map", "ℹ️ About"])
-with tab0:
-    st.title("Equity Considerations")
-    variables = visualiser.variable_selection(equity_calculator)
-    weights_mapping = visualiser.weights_input()
-    if None not in variables:
-        calculated_flows = equity_calculator.calculate_weighted_equity(weights_mapping, variables, total_value)
-        calculated_contributions = equity_calculator.calculate_contributions(weights_mapping, variables, total_value, include_UMIC=include_UMIC, exclude_US=exclude_US)
-with tab1:
-    st.title("Climate Finance Recipient Flows")
-    if None not in variables:
-        visualiser.plot_ranking_table(calculated_flows, "Allocation_USDbn")
-        regional_flows = equity_calculator.aggregate_to_regions(calculated_flows)
-        visualiser.plot_ranking_table(regional_flows, "Allocation_USDbn")
-with tab2: 
-    st.title("Climate Finance Contributions")
-    if None not in variables:
-        visualiser.plot_ranking_table(calculated_contributions, "Contributions_USDbn")
-with tab3: 
-    st.title("Robust distribution of climate finance")
-    
-    #robust_flows["Robust_Allocation_USDbn"] = robust_flows["Robust_Share"] * total_value
-    
-    robust_contributions, contributions_summary = equity_calculator.calculate_robust_contributions(exclude_US=True, include_UMIC=False)
-    obust_contributions, contributions_summary = equity_calculator.calculate_robust_contributions(exclude_US=False, include_UMIC=True)
-    robust_contributions, contributions_summary = equity_calculator.calculate_robust_contributions(exclude_US=True, include_UMIC=True)
-    robust_contributions["Robust_Allocation_USDbn"] = robust_contributions["Robust_Contribution"] * total_value
-    visualiser.plot_ranking_table(robust_contributions, "Robust_Allocation_USDbn")
-
-with tab4: 
-    st.title("Robust allocation of climate finance")
-    robust_flows, robust_summary = equity_calculator.calculate_robust_allocation()
-    robust_flows["Robust_Allocation_USDbn"] = robust_flows["Robust_Share"] * total_value
-    visualiser.plot_ranking_table(robust_flows, "Robust_Allocation_USDbn")
+
+
+@st.fragment
+def scenario_tabs(total_value, include_UMIC, exclude_US):
+    """
+    Weighting, Allocations and Contributions tabs; moving a slider or changing a variable reruns only these
+    """
+
+    with tab0:
+        st.title("Equity Considerations")
+        variables = visualiser.variable_selection(equity_calculator)
+        weights_mapping = visualiser.weights_input()
+        # Per-session incremental scenario over the shared calculator
+        if "scenario" not in st.session_state or st.session_state["scenario"].equity_calculator is not equity_calculator:
+            st.session_state["scenario"] = Scenario(equity_calculator)
+        scenario = st.session_state["scenario"].update(weights_mapping, variables, total_value, include_UMIC=include_UMIC, exclude_US=exclude_US)
+    with tab1:
+        st.title("Climate Finance Recipient Flows")
+        if None not in variables:
+            visualiser.plot_ranking_table(scenario.allocations, "Allocation_USDbn")
+            regional_flows = equity_calculator.aggregate_to_regions(scenario.allocations)
+            visualiser.plot_ranking_table(regional_flows, "Allocation_USDbn")
+    with tab2:
+        st.title("Climate Finance Contributions")
+        if None not in variables:
+            visualiser.plot_ranking_table(scenario.contributions, "Contributions_USDbn")
+
+
+@st.fragment(run_every=2)
+def wait_for_robust_results():
+    """
+    Placeholder shown while the background build runs; reruns the app once the results are ready
+    """
+
+    if results_future.done():
+        st.rerun()
+    st.info("Robust results are being computed in the background and will appear here when ready.")
+
+
+scenario_tabs(total_value, include_UMIC, exclude_US)
+
+if not results_future.done():
+    with tab3:
+        st.title("Robust distribution of climate finance")
+        wait_for_robust_results()
+    with tab4:
+        st.title("Robust allocation of climate finance")
+        st.info("Robust results are being computed in the background and will appear here when ready.")
+else:
+    # All robust runs are read from the memory-mapped results store instead of being recomputed
+    results_store = get_results_store(data_version)
+    with tab3:
+        st.title("Robust distribution of climate finance")
+        robust_contributions, _ = results_store.open("contributions_UMIC").rank_stability()
+        robust_contributions["Robust_Allocation_USDbn"] = robust_contributions["Robust_Share"] * total_value
+        robust_contributions["P5_USDbn"] = robust_contributions["Share_P5"] * total_value
+        robust_contributions["P95_USDbn"] = robust_contributions["Share_P95"] * total_value
+        visualiser.plot_ranking_table(robust_contributions, "Robust_Allocation_USDbn", ("P5_USDbn", "P95_USDbn"))
+        visualiser.plot_rank_stability(robust_contributions)
+
+    with tab4:
+        st.title("Robust allocation of climate finance")
+        robust_flows, _ = results_store.open("allocations").rank_stability()
+        robust_flows["Robust_Allocation_USDbn"] = robust_flows["Robust_Share"] * total_value
+        robust_flows["P5_USDbn"] = robust_flows["Share_P5"] * total_value
+        robust_flows["P95_USDbn"] = robust_flows["Share_P95"] * total_value
+        visualiser.plot_ranking_table(robust_flows, "Robust_Allocation_USDbn", ("P5_USDbn", "P95_USDbn"))
+        visualiser.plot_rank_stability(robust_flows)
 with tab5:
     st.write("INCLUDE DETAILS")
\ No newline at end of file
@@ -67,20 +67,35 @@ class Visualiser():
         return selected_variables
 
 
-    def plot_ranking_table(self, dataframe, value_column):
+    def plot_ranking_table(self, dataframe, value_column, interval_columns=None):
+        """
+        Horizontal bar chart of value_column per country, largest first
+        Inputs:
+            interval_columns: Optional (low, high) columns in the units of value_column, e.g. the P5 and P95
+                bands of a rank-stability report, drawn as error bars
+        """
 
 
         # Melt dataframe
         df = dataframe[["Country", "ISO", value_column]].copy()
         df = df.rename(columns={value_column: "Value", "ISO":"Country code"})
+        tooltip = [alt.Tooltip('Country:N', title='Country'),  # <-- show country name
+                   alt.Tooltip('sum(Value):Q', title='Value (USD bn)', format='0.1f')]
+
+        # Layers sharing the country axis need the same explicit order
+        y_sort = "-x"
+        if interval_columns is not None:
+            df["Low"] = dataframe[interval_columns[0]].to_numpy()
+            df["High"] = dataframe[interval_columns[1]].to_numpy()
+            y_sort = df.sort_values("Value", ascending=False, kind="stable")["Country code"].tolist()
+            tooltip += [alt.Tooltip('min(Low):Q', title='Low (USD bn)', format='0.1f'),
+                        alt.Tooltip('max(High):Q', title='High (USD bn)', format='0.1f')]
 
         # Create chart
         chart = alt.Chart(df).mark_bar().encode(
             x=alt.X('sum(Value):Q', stack='zero', title='Annual flows (USD billion)'),
-            y=alt.Y('Country code:O', sort="-x", title='Country'),
-              tooltip=[
-        alt.Tooltip('Country:N', title='Country'),  # <-- show country name
-        alt.Tooltip('sum(Value):Q', title='Value (USD bn)', format='0.1f')]  # Sort countries by total value descending
+            y=alt.Y('Country code:O', sort=y_sort, title='Country'),  # Sort countries by total value descending
+            tooltip=tooltip
     ).properties(width=700)
 
         # Add x-axis to the top
@@ -89,9 +104,32 @@ class Visualiser():
         )
 
         # Combine the original chart and the one with the top axis
-        chart_with_double_x_axis = alt.layer(
-            chart,
-            x_axis_top
+        layers = [chart, x_axis_top]
+        if interval_columns is not None:
+            layers.append(alt.Chart(df).mark_errorbar(ticks=True).encode(
+                x=alt.X('Low:Q', title=''),
+                x2='High:Q',
+                y=alt.Y('Country code:O', sort=y_sort),
+            ))
+        chart_with_double_x_axis = alt.layer(*layers)
+
+        st.write(chart_with_double_x_axis)
+
+    def plot_rank_stability(self, report, top_n=10):
+        """
+        Table of each country's median rank, its P5-P95 rank band and the probability of a top-N place,
+        from a rank-stability report (see rank_stability.calculate_rank_stability)
+        """
+
+        table = report.sort_values(["Rank_P50", "Mean_Rank"])
+        st.dataframe(
+            pd.DataFrame({
+                "Country": table["Country"],
+                "Median rank": table["Rank_P50"],
+                "Rank range (P5-P95)": table["Rank_P5"].astype(str) + "-" + table["Rank_P95"].astype(str),
+                f"Top {top_n} probability": table[f"P_Top{top_n}"],
+            }),
+            hide_index=True,
+            column_config={f"Top {top_n} probability": st.column_config.ProgressColumn(
+                format="%.2f", min_value=0.0, max_value=1.0)},
         )
-
-        st.write(chart_with_double_x_axis)
\ No newline at end of file